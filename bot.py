@@ -1,12 +1,27 @@
 import os
+import sys
 import re
 import random
 import threading
+import time
 import html
+import io
+import gzip
 import json
+import zlib
+import lzma
+import base64
+import hashlib
 import asyncio
+import sqlite3
+import subprocess
+import bisect
+import uuid
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Optional, Set, Tuple, List
+from typing import Callable, Deque, Dict, Iterable, Optional, Set, Tuple, List
 
 from flask import Flask
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, User, InputFile
@@ -24,7 +39,7 @@ if not API_TOKEN:
 
 GIST_TOKEN = os.getenv("GIST_TOKEN")
 GIST_ID = os.getenv("GIST_ID")
-GIST_FILENAME = os.getenv("GIST_FILENAME", "chat_state.json")
+GIST_FILENAME = os.getenv("GIST_FILENAME", "chat_state.json")  # старый монолитный файл; шарды — <имя>.global.b64 / <имя>.<chat_id>.b64
 
 SELF_URL = os.getenv("SELF_URL")
 OWNER_ID = int(os.getenv("OWNER_ID", "0"))  # Telegram user id владельца (для allowlist)
@@ -34,11 +49,58 @@ NICK_COOLDOWN = timedelta(hours=1)
 TRIGGER_COOLDOWN = timedelta(seconds=20)
 REP_DAILY_LIMIT = 10
 REP_WINDOW = timedelta(hours=24)
+TRIGGER_BUDGET_MS = 50     # матчинг триггеров на одно сообщение дольше — ищем виноватый регэксп
+TRIGGER_STRIKES = 3        # столько превышений — триггер выключается, автору уходит ЛС
+TRIGGER_VET_MAX_MS = 20    # новый регэксп: худшее время на строку корпуса при проверке
+TRIGGER_VET_SEC = 3.0      # жёсткий таймаут процесса проверки
 UTC = timezone.utc
 
 # Прочее
 ADMINS_TTL_SEC = 600
-LOCAL_BACKUP = "state_backup.json"
+EXPORT_GZIP_BYTES = 1 << 20              # экспорт больше — отдаём .json.gz
+EXPORT_CHUNK_BYTES = 45 * 1024 * 1024    # лимит документа у Bot API — 50 МБ, режем с запасом
+IMPORT_MAX_BYTES = 20 * 1024 * 1024      # больше бот всё равно не скачает (лимит getFile)
+LOCAL_BACKUP = "state_backup.json"              # старый JSON-формат: только чтение при миграции
+LOCAL_SNAPSHOT = os.getenv("LOCAL_SNAPSHOT", "state_snapshot.bin")
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC", "zlib")  # zlib | lzma | none
+GIST_META = LOCAL_SNAPSHOT + ".gist"  # ETag и дайджесты шардов, которые сейчас лежат в гисте
+
+# Старт: fast — поднимаемся с локального снапшота сразу, гист сверяем в фоне; blocking — ждём гист до поллинга
+STARTUP_MODE = os.getenv("STARTUP", "fast")
+
+# Хранилище: json — весь стейт в памяти + state_backup.json/gist; sqlite — база с ленивой загрузкой чатов
+STORAGE_BACKEND = os.getenv("STORAGE", "json")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "state.db")
+
+# Справочник пользователей (KNOWN/NAMES): в памяти — последние USERS_HOT_MAX записей,
+# остальное — в локальной SQLite USERS_DB (кеш снапшота, на старте пересобирается из него)
+USERS_HOT_MAX = int(os.getenv("USERS_HOT_MAX", "5000"))
+USERS_DB = os.getenv("USERS_DB", "users.db")
+
+# Простаивающие чаты: без правок CHAT_IDLE_DAYS дней — выгружаются из памяти в COLD_DIR/<chat_id>.bin
+# и поднимаются обратно при первом обращении (0 — не выгружать)
+CHAT_IDLE_DAYS = float(os.getenv("CHAT_IDLE_DAYS", "14"))
+COLD_DIR = os.getenv("COLD_DIR", "cold_chats")
+IDLE_CHECK_SEC = 3600
+
+# Планировщик сохранений: правки админов копятся SAVE_DEBOUNCE_SEC (но не дольше SAVE_MAX_DELAY_SEC),
+# фоновые чекпоинты — раз в SAVE_MIN..SAVE_MAX_INTERVAL в зависимости от активности и размера снапшота
+SAVE_DEBOUNCE_SEC = float(os.getenv("SAVE_DEBOUNCE_SEC", "3"))
+SAVE_MAX_DELAY_SEC = float(os.getenv("SAVE_MAX_DELAY_SEC", "15"))
+SAVE_MIN_INTERVAL = float(os.getenv("SAVE_MIN_INTERVAL", "60"))
+SAVE_MAX_INTERVAL = float(os.getenv("SAVE_MAX_INTERVAL", "600"))
+
+# Исходящий HTTP (gist, keepalive): один пул соединений на процесс
+HTTP2 = os.getenv("HTTP2", "1") != "0"          # включится, только если установлен пакет h2
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))  # повторы на 5xx/429/сетевые ошибки
+HTTP_BACKOFF_SEC = 0.5                           # база экспоненциальной паузы между повторами
+
+# Журнал мутаций (WAL) между снапшотами
+JOURNAL_ENABLED = os.getenv("JOURNAL", "1") != "0"
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "state_journal.log")
+JOURNAL_FLUSH_SEC = float(os.getenv("JOURNAL_FLUSH_SEC", "1.0"))      # fsync пачкой раз в N сек
+JOURNAL_BATCH = 512                                                   # или раньше, если накопилось столько записей
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(1 << 20)))  # порог фонового снапшота
 
 # ========= ТЕКСТЫ =========
 WELCOME_TEXT = (
@@ -50,6 +112,7 @@ HELP_TEXT = (
     "• /start — открыть меню\n"
     "• /nick — ник себе; /nick @user или ответом — ник другу\n"
     "• /8ball вопрос — магический шар отвечает\n"
+    "• /rank — твоё место по репе и активности (или ответом — чужое)\n"
     "• +1 / -1 — репутация по реплаю или с @username\n"
     "• «📊 Статистика» — топ-10 репы, ники, активность и ачивки\n\n"
     "Для админов — набери /admin (в группе) или в ЛС: будет меню."
@@ -63,18 +126,23 @@ ADMIN_MENU_TEXT = (
     "• /resettriggers — вернуть дефолтные триггеры\n"
     "• /reset — сбросить ВСЮ историю чата (подтверждение)\n"
     "• /resetuser @user (или по реплаю в группе)\n"
-    "• /export, /export_here, /import — бэкапы\n"
+    "• /export, /export_here, /import [merge] — бэкапы (файл с подписью /import)\n"
     "• /diag — диагностика\n\n"
     "Для владельца:\n"
     "• /allowchat — разрешить текущий чат\n"
     "• /denychat — запретить и стереть данные чата\n"
-    "• /listchats — список разрешённых чатов"
+    "• /listchats — список разрешённых чатов\n"
+    "• /import full — заменить состояние ВСЕХ чатов из файла"
 )
 STATS_TITLE = "📊 Статистика"
 
 # ========= КНОПКИ =========
 BTN_HELP  = "help_info"
 BTN_STATS = "stats_open"
+# страницы статистики: callback_data = "stats:<раздел>:<страница>"
+BTN_STATS_PAGE = "stats:"
+STATS_SECTIONS: Dict[str, str] = {"top": "🏆 Топы", "nicks": "📝 Ники", "ach": "🏅 Ачивки"}
+STATS_PAGE_SIZE: Dict[str, int] = {"nicks": 25, "ach": 6}  # строка ачивок длинная — страница короче
 
 def main_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
@@ -82,19 +150,212 @@ def main_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("📊 Статистика", callback_data=BTN_STATS)],
     ])
 
+def stats_keyboard(section: str, page: int, pages: int) -> InlineKeyboardMarkup:
+    rows = []
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"{BTN_STATS_PAGE}{section}:{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"{BTN_STATS_PAGE}{section}:{page}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"{BTN_STATS_PAGE}{section}:{page + 1}"))
+        rows.append(nav)
+    rows.append([InlineKeyboardButton(label, callback_data=f"{BTN_STATS_PAGE}{s}:0")
+                 for s, label in STATS_SECTIONS.items() if s != section])
+    return InlineKeyboardMarkup(rows)
+
 # ========= ПАМЯТЬ (in-memory) =========
 # Allowlist чатов: только здесь бот полноценно работает
 ALLOW_CHATS: Set[int] = set()
 CHAT_TITLES: Dict[int, str] = {}  # красиво показывать в списках
 
-# — ники
-NICKS: Dict[int, Dict[int, str]] = {}
-TAKEN: Dict[int, Set[str]] = {}
-LAST_NICK: Dict[int, datetime] = {}
-
-# — известные @username и имена
-KNOWN: Dict[str, int] = {}  # username_lower -> user_id
-NAMES: Dict[int, str] = {}  # user_id -> display (@username > full_name)
+# — ники: кулдаун смены (глобально), uid -> окно NICK_LIMIT
+LAST_NICK: Dict[int, Deque[int]] = {}
+
+# — известные @username и имена: горячий LRU в памяти + холодная таблица на диске
+_USERS_CONN: Optional[sqlite3.Connection] = None
+
+def _users_db() -> sqlite3.Connection:
+    global _USERS_CONN
+    if _USERS_CONN is None:
+        conn = sqlite3.connect(USERS_DB, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for table, kind in (("known", "TEXT"), ("names", "INTEGER")):
+            # источник правды — снапшот, он поставит всё заново
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.execute(f"CREATE TABLE {table} (k {kind} PRIMARY KEY, v NOT NULL, b INTEGER NOT NULL)")
+            conn.execute(f"CREATE INDEX {table}_b ON {table} (b)")
+        _USERS_CONN = conn
+    return _USERS_CONN
+
+_USERS_WRITER: Optional[sqlite3.Connection] = None  # своё соединение воркера чекпоинтов
+_USERS_WRITE_LOCK = threading.Lock()
+
+def _users_writer() -> sqlite3.Connection:
+    global _USERS_WRITER
+    if _USERS_WRITER is None:
+        _users_db()  # таблицы
+        _USERS_WRITER = sqlite3.connect(USERS_DB, check_same_thread=False, isolation_level=None)
+    return _USERS_WRITER
+
+def _users_close():
+    global _USERS_CONN, _USERS_WRITER
+    with _USERS_WRITE_LOCK:
+        for conn in (_USERS_CONN, _USERS_WRITER):
+            if conn is not None:
+                conn.close()
+        _USERS_CONN = _USERS_WRITER = None
+
+# Справочник в снапшоте режется на бакеты по ключу: правка одного имени пересобирает один бакет
+USERS_BUCKETS = 256
+
+def _users_bucket(key) -> int:
+    return zlib.crc32(str(key).encode("utf-8")) % USERS_BUCKETS
+
+class _ColdView:
+    """Содержимое холодной таблицы для сериализации: читается своим соединением (можно из воркера)."""
+    __slots__ = ("table",)
+
+    def __init__(self, table: str):
+        self.table = table
+
+    def items(self) -> List[tuple]:
+        conn = sqlite3.connect(USERS_DB)
+        try:
+            return conn.execute(f"SELECT k, v FROM {self.table}").fetchall()
+        finally:
+            conn.close()
+
+class UsersDelta:
+    """KNOWN/NAMES в снимке чекпоинта: строки, изменённые с прошлого (снятые под локом).
+    В воркере apply() пишет их в таблицу и в той же транзакции читает бакеты — срез на момент
+    снимка: whole — все (полный текст секции), иначе только задетые этими строками.
+    Текст справочника между чекпоинтами в памяти не держим — источник таблица на диске."""
+    __slots__ = ("table", "rows", "whole")
+
+    def __init__(self, table: str, rows: dict, whole: bool):
+        self.table, self.rows, self.whole = table, rows, whole
+
+    def apply(self) -> Dict[int, str]:
+        """Воркер: бакет -> кусок "[k,v],[k,v]" (пустая строка — бакет опустел)."""
+        touched = range(USERS_BUCKETS) if self.whole else sorted({_users_bucket(k) for k in self.rows})
+        with _USERS_WRITE_LOCK:
+            conn = _users_writer()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(f"INSERT OR REPLACE INTO {self.table} (k, v, b) VALUES (?, ?, ?)",
+                                 [(k, v, _users_bucket(k)) for k, v in self.rows.items()])
+                buckets = {b: ",".join(_dumps(list(kv)) for kv in
+                                       conn.execute(f"SELECT k, v FROM {self.table} WHERE b = ? ORDER BY k", (b,)))
+                           for b in touched}
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return buckets
+
+class TieredMap:
+    """dict-подобный стор: последние hot_max ключей в памяти (LRU), остальное — в SQLite.
+    Промах подтягивает запись с диска; изменения копятся в pending и пишутся пачкой — чекпоинтом
+    (take_delta -> inflight -> воркер) или flush() для экспорта."""
+
+    def __init__(self, table: str, hot_max: int):
+        self.table = table
+        self.hot_max = hot_max
+        self.hot: "OrderedDict[object, object]" = OrderedDict()
+        self.pending: Dict[object, object] = {}  # ещё не записано на диск
+        self.inflight: Dict[object, object] = {}  # отдано чекпоинту, воркер ещё не записал
+        self.faults = 0
+        self.evictions = 0
+
+    def _keep(self, key, val):
+        self.hot[key] = val
+        self.hot.move_to_end(key)
+        if len(self.hot) > self.hot_max:
+            self.hot.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        val = self.hot.get(key)
+        if val is not None:
+            self.hot.move_to_end(key)
+            return val
+        val = self.pending.get(key)
+        if val is None:
+            val = self.inflight.get(key)
+        if val is None:
+            row = _users_db().execute(f"SELECT v FROM {self.table} WHERE k = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            val = row[0]
+        self.faults += 1
+        self._keep(key, val)
+        return val
+
+    def __getitem__(self, key):
+        val = self.get(key)
+        if val is None:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __setitem__(self, key, val):
+        self.pending[key] = val
+        self._keep(key, val)
+
+    def _write(self, rows: List[tuple]):
+        with _USERS_WRITE_LOCK:
+            conn = _users_db()
+            conn.execute("BEGIN")
+            conn.executemany(f"INSERT OR REPLACE INTO {self.table} (k, v, b) VALUES (?, ?, ?)",
+                             [(k, v, _users_bucket(k)) for k, v in rows])
+            conn.execute("COMMIT")
+
+    def flush(self):
+        if not self.pending:
+            return
+        self._write(list(self.pending.items()))
+        self.pending.clear()
+
+    def take_delta(self, whole: bool) -> UsersDelta:
+        """Под STATE_LOCK, без диска: изменённое с прошлого чекпоинта (и не долетевшее в прошлый раз)."""
+        self.inflight.update(self.pending)
+        self.pending.clear()
+        return UsersDelta(self.table, dict(self.inflight), whole)
+
+    def copy(self) -> _ColdView:
+        _users_db()
+        self.flush()
+        return _ColdView(self.table)
+
+    def items(self) -> List[tuple]:
+        return self.copy().items()
+
+    def clear(self):
+        self.hot.clear()
+        self.pending.clear()
+        self.inflight.clear()
+        with _USERS_WRITE_LOCK:
+            _users_db().execute(f"DELETE FROM {self.table}")
+
+    def update(self, items):
+        rows = list(items.items() if hasattr(items, "items") else items)
+        for key, _ in rows:
+            self.hot.pop(key, None)
+            self.pending.pop(key, None)
+            self.inflight.pop(key, None)
+        self._write(rows)
+
+    def __len__(self) -> int:
+        self.flush()
+        return _users_db().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+KNOWN = TieredMap("known", USERS_HOT_MAX)  # username_lower -> user_id
+NAMES = TieredMap("names", USERS_HOT_MAX)  # user_id -> display (@username > full_name)
+NAMES_VERSION = 0  # растёт при каждой правке NAMES — по нему протухают отрендеренные списки
 
 # — триггеры: конфигируемые per-chat
 class TriggerCfg(dict): ...
@@ -102,30 +363,242 @@ class TriggerCfg(dict): ...
 TRIGGERS_CFG: Dict[int, List[TriggerCfg]] = {}
 
 # — служебное: компилированные regex для быстрого матчинга
-TRIGGERS_COMPILED: Dict[int, List[Tuple[re.Pattern, List[str], str, bool]]] = {}  # chat_id -> [(pattern, answers, name, enabled)]
-
-# — спам/тайминги
-LAST_TRIGGER_TIME: Dict[int, datetime] = {}
-
-# — репутация/счётчики — ПО ЧАТАМ
-REP_GIVEN: Dict[int, Dict[int, int]] = {}
-REP_RECEIVED: Dict[int, Dict[int, int]] = {}
-REP_POS_GIVEN: Dict[int, Dict[int, int]] = {}
-REP_NEG_GIVEN: Dict[int, Dict[int, int]] = {}
-REP_GIVE_TIMES: Dict[int, Dict[int, List[datetime]]] = {}
-
-MSG_COUNT: Dict[int, Dict[int, int]] = {}
-CHAR_COUNT: Dict[int, Dict[int, int]] = {}
-NICK_CHANGE_COUNT: Dict[int, Dict[int, int]] = {}
-EIGHTBALL_COUNT: Dict[int, Dict[int, int]] = {}
-TRIGGER_HITS: Dict[int, Dict[int, int]] = {}
-BEER_HITS: Dict[int, Dict[int, int]] = {}
-LAST_MSG_AT: Dict[int, Dict[int, datetime]] = {}
-
-ADMIN_PLUS_GIVEN: Dict[int, Dict[int, int]] = {}
-ADMIN_MINUS_GIVEN: Dict[int, Dict[int, int]] = {}
-
-ACHIEVEMENTS: Dict[int, Dict[int, Set[str]]] = {}
+TRIGGERS_COMPILED: Dict[int, "TriggerMatcher"] = {}  # chat_id -> [(pattern, answers, name, enabled)] + общий regex
+
+# — спам/тайминги: chat_id -> окно TRIGGER_LIMIT
+LAST_TRIGGER_TIME: Dict[int, Deque[int]] = {}
+
+# — репутация/счётчики/ники/ачивки — ПО ЧАТАМ: chat_id -> ChatState(uid -> UserStats)
+class UserStats:
+    """Всё, что бот знает о пользователе в одном чате. Время — epoch-секунды (0 — не было),
+    ачивки — битовая маска по позиции в ACH_LIST."""
+    __slots__ = ("nick", "rep_given", "rep_received", "rep_pos_given", "rep_neg_given",
+                 "msg_count", "char_count", "nick_change_count", "eightball_count",
+                 "trigger_hits", "beer_hits", "admin_plus_given", "admin_minus_given",
+                 "last_msg_at", "ach")
+
+    def __init__(self):
+        self.nick: Optional[str] = None
+        self.rep_given = 0
+        self.rep_received = 0
+        self.rep_pos_given = 0
+        self.rep_neg_given = 0
+        self.msg_count = 0
+        self.char_count = 0
+        self.nick_change_count = 0
+        self.eightball_count = 0
+        self.trigger_hits = 0
+        self.beer_hits = 0
+        self.admin_plus_given = 0
+        self.admin_minus_given = 0
+        self.last_msg_at = 0
+        self.ach = 0
+
+class Leaderboard:
+    """Упорядоченный индекс (-счёт, uid) по одному полю UserStats: топ — срез, место — bisect."""
+    __slots__ = ("keys",)
+
+    def __init__(self, scores: Iterable[Tuple[int, int]] = ()):
+        self.keys: List[Tuple[int, int]] = sorted((-score, uid) for uid, score in scores if score)
+
+    def update(self, uid: int, old: int, new: int):
+        if old:
+            del self.keys[bisect.bisect_left(self.keys, (-old, uid))]
+        if new:
+            bisect.insort(self.keys, (-new, uid))
+
+    def top(self, k: int) -> List[Tuple[int, int]]:
+        return [(uid, -score) for score, uid in self.keys[:k]]
+
+    def rank(self, score: int) -> Optional[int]:
+        """Место для такого счёта (при равенстве — общее), None — в индексе не участвует."""
+        if not score:
+            return None
+        return bisect.bisect_left(self.keys, (-score,)) + 1
+
+# поля с лидербордами: индекс строится при первом запросе и дальше правится в _bump/_count_message
+RANKED_FIELDS: Tuple[str, ...] = ("rep_received", "msg_count")
+
+# части сообщения статистики и поля UserStats, от которых они зависят
+STATS_PARTS: Tuple[str, ...] = ("rep", "nicks", "msgs", "ach")
+STATS_PART_OF: Dict[str, str] = {"rep_received": "rep", "msg_count": "msgs", "char_count": "msgs"}
+
+TRIGGER_COUNTERS = ("evals", "matches", "fires", "suppressed", "ns")
+
+class TriggerStats:
+    """Счётчики триггеров чата: по массиву на счётчик, индексы — как в TRIGGERS_COMPILED.
+    evals — дошёл до regex (прошёл префильтр), matches — выбран первым совпавшим,
+    fires — ответил, suppressed — совпал, но съел кулдаун, ns — время матчинга.
+    Сохраняются по id триггера (TRIGGER_STATS: {id: [evals, matches, fires, suppressed, ns]})."""
+    __slots__ = ("source", "ids", "parked") + TRIGGER_COUNTERS
+
+    def __init__(self, by_id: Optional[Dict[str, List[int]]] = None):
+        self.source = None  # матчер, по которому выровнены массивы
+        self.ids: Tuple[str, ...] = ()
+        self.parked: Dict[str, List[int]] = dict(by_id or {})  # ещё не выровненные (после загрузки)
+        for f in TRIGGER_COUNTERS:
+            setattr(self, f, array("Q"))
+
+    def by_id(self) -> Dict[str, List[int]]:
+        out = dict(self.parked)
+        for i, tid in enumerate(self.ids):
+            row = [getattr(self, f)[i] for f in TRIGGER_COUNTERS]
+            if any(row):
+                out[tid] = row
+        return out
+
+    def align(self, source, ids: Tuple[str, ...]):
+        """Перестроить массивы под новый список триггеров; счётчики удалённых пропадают."""
+        rows = self.by_id()
+        zero = [0] * len(TRIGGER_COUNTERS)
+        for k, f in enumerate(TRIGGER_COUNTERS):
+            setattr(self, f, array("Q", (rows.get(tid, zero)[k] for tid in ids)))
+        self.source, self.ids, self.parked = source, ids, {}
+
+    def add(self, by_id: Dict[str, List[int]]):
+        """Импорт-слияние: счётчики складываются."""
+        rows = self.by_id()
+        for tid, row in by_id.items():
+            cur = rows.get(tid, [0] * len(TRIGGER_COUNTERS))
+            rows[tid] = [a + b for a, b in zip(cur, row)]
+        self.source, self.ids, self.parked = None, (), rows
+        for f in TRIGGER_COUNTERS:
+            setattr(self, f, array("Q"))
+
+class ChatState:
+    """Состояние чата. TAKEN не хранится — taken это индексы ников из users в NICK_SPACE
+    (ники не из генератора в нём не участвуют), pool — свободные индексы, строится при первом /nick.
+    rep_rings — окна REP_LIMIT выдавших репу (REP_GIVE_TIMES), boards — лидерборды RANKED_FIELDS.
+    version растёт при любой правке, changed — версия последней правки каждой части статистики,
+    render — кеш отрендеренного (часть -> (штамп, результат)), trig — счётчики триггеров."""
+    __slots__ = ("users", "taken", "pool", "rep_rings", "boards", "version", "changed", "render", "trig")
+
+    def __init__(self, users: Optional[Dict[int, UserStats]] = None, rep_rings: Optional[Dict[int, Deque[int]]] = None,
+                 trig_stats: Optional[Dict[str, List[int]]] = None):
+        self.users: Dict[int, UserStats] = users if users is not None else {}
+        self.taken: Set[int] = set()
+        for u in self.users.values():
+            i = _nick_index(u.nick) if u.nick else None
+            if i is not None:
+                self.taken.add(i)
+        self.pool: Optional[NickPool] = None
+        self.rep_rings: Dict[int, Deque[int]] = rep_rings if rep_rings is not None else {}
+        self.boards: Dict[str, Leaderboard] = {}
+        self.version = 0
+        self.changed: Dict[str, int] = {}
+        self.render: Dict[str, Tuple[tuple, object]] = {}
+        self.trig = TriggerStats(trig_stats)
+
+    def user(self, uid: int) -> UserStats:
+        u = self.users.get(uid)
+        if u is None:
+            u = self.users[uid] = UserStats()
+        return u
+
+    def _hold(self, nick: Optional[str], held: bool):
+        i = _nick_index(nick) if nick else None
+        if i is None:
+            return
+        if held:
+            self.taken.add(i)
+            if self.pool is not None:
+                self.pool.take(i)
+        else:
+            self.taken.discard(i)
+            if self.pool is not None:
+                self.pool.release(i)
+
+    def nick_taken(self, nick: str) -> bool:
+        i = _nick_index(nick)
+        if i is None:
+            return any(u.nick == nick for u in self.users.values())
+        return i in self.taken
+
+    def new_nick(self) -> Optional[str]:
+        """Случайный свободный ник за O(1); None — пространство ников чата исчерпано."""
+        if self.pool is None:
+            self.pool = NickPool(NICK_SPACE, self.taken)
+        i = self.pool.pick()
+        return None if i is None else _nick_text(i)
+
+    def set_nick(self, uid: int, nick: str):
+        u = self.user(uid)
+        self._hold(u.nick, False)
+        u.nick = nick
+        self._hold(nick, True)
+
+    def drop(self, uid: int):
+        u = self.users.pop(uid, None)
+        if u is not None:
+            self._hold(u.nick, False)
+            for field, board in self.boards.items():
+                board.update(uid, getattr(u, field), 0)
+        self.rep_rings.pop(uid, None)
+        self.bump(*STATS_PARTS)
+
+    def bump(self, *parts: str):
+        """Отметить правку: общая версия + версии затронутых частей статистики."""
+        self.version += 1
+        for part in parts:
+            self.changed[part] = self.version
+
+    def board(self, field: str) -> Leaderboard:
+        b = self.boards.get(field)
+        if b is None:
+            b = self.boards[field] = Leaderboard((uid, getattr(u, field)) for uid, u in self.users.items())
+        return b
+
+    def scored(self, uid: int, field: str, old: int, new: int):
+        """Счёт поля изменился — поправить лидерборд, если он уже построен."""
+        b = self.boards.get(field)
+        if b is not None:
+            b.update(uid, old, new)
+
+CHATS: Dict[int, ChatState] = {}
+
+# — лимиты: «не больше limit событий за window» на ключ
+class SlidingWindow:
+    """Окно ключа — кольцо epoch-секунд (deque с maxlen=limit): проверка и отметка O(1),
+    «через сколько» — точно, по самому старому событию. Кольца живут в переданном dict."""
+    __slots__ = ("limit", "window")
+
+    def __init__(self, limit: int, window: timedelta):
+        self.limit = limit
+        self.window = int(window.total_seconds())
+
+    def ring(self, times: Iterable[int] = ()) -> Deque[int]:
+        return deque(sorted(times), maxlen=self.limit)
+
+    def wait(self, ring: Optional[Deque[int]], now: int) -> int:
+        """Сколько секунд до следующего разрешённого события (0 — можно сейчас)."""
+        if not ring or len(ring) < self.limit:
+            return 0
+        return max(0, ring[0] + self.window - now)
+
+    def note(self, rings: dict, key, ts: int):
+        ring = rings.get(key)
+        if ring is None:
+            ring = rings[key] = deque(maxlen=self.limit)
+        ring.append(ts)
+
+    def admit(self, rings: dict, key, now: int) -> int:
+        """Пропустить и отметить событие; иначе вернуть, сколько секунд ждать (ничего не отмечая)."""
+        left = self.wait(rings.get(key), now)
+        if not left:
+            self.note(rings, key, now)
+        return left
+
+    def sweep(self, rings: dict, now: int) -> int:
+        """Выкинуть ключи, у которых окно целиком истекло; вернуть их число."""
+        dead = [key for key, ring in rings.items() if not ring or ring[-1] + self.window <= now]
+        for key in dead:
+            del rings[key]
+        return len(dead)
+
+REP_LIMIT = SlidingWindow(REP_DAILY_LIMIT, REP_WINDOW)
+NICK_LIMIT = SlidingWindow(1, NICK_COOLDOWN)
+TRIGGER_LIMIT = SlidingWindow(1, TRIGGER_COOLDOWN)
+LIMITS_SWEEP_SEC = 600
 
 # — кеш админов: chat_id -> (set(user_id), expires_ts)
 ADMINS_CACHE: Dict[int, Tuple[Set[int], float]] = {}
@@ -136,6 +609,21 @@ ADMIN_SESS: Dict[int, Dict[str, any]] = {}  # key: admin user_id
 # — локи
 STATE_LOCK = asyncio.Lock()
 
+# — реестр per-chat счётчиков (имя секции -> поле UserStats), по нему работают _inc и сериализация
+COUNTER_SECTIONS: Dict[str, str] = {
+    section: section.lower() for section in (
+        "REP_GIVEN", "REP_RECEIVED", "REP_POS_GIVEN", "REP_NEG_GIVEN",
+        "MSG_COUNT", "CHAR_COUNT", "NICK_CHANGE_COUNT", "EIGHTBALL_COUNT",
+        "TRIGGER_HITS", "BEER_HITS", "ADMIN_PLUS_GIVEN", "ADMIN_MINUS_GIVEN",
+    )
+}
+
+# — чекпоинты: что изменилось с прошлого сохранения
+SAVE_MODE = os.getenv("SAVE_MODE", "delta")  # delta — перекодируем только грязное; full — как раньше, всё целиком
+GLOBAL_SECTIONS: Tuple[str, ...] = ("ALLOW_CHATS", "CHAT_TITLES", "LAST_NICK", "KNOWN", "NAMES")
+_DIRTY_CHATS: Set[int] = set()
+_DIRTY_GLOBAL: Set[str] = set()
+
 # ========= ДЕФОЛТНЫЕ ТРИГГЕРЫ (МИГРИРУЮТСЯ В CFG ПРИ НУЖДЕ) =========
 DEFAULT_TRIGGERS: List[TriggerCfg] = [
     TriggerCfg({
@@ -221,6 +709,8 @@ DEFAULT_TRIGGERS: List[TriggerCfg] = [
         "enabled": True
     }),
 ]
+# Дефолтные триггеры общие для всех чатов: чат держит ссылку на объект отсюда, пока не правит его
+DEFAULT_TRIGGERS_BY_ID: Dict[str, TriggerCfg] = {t["id"]: t for t in DEFAULT_TRIGGERS}
 
 # ========= АЧИВКИ =========
 ACH_LIST: Dict[str, Tuple[str, str]] = {
@@ -252,69 +742,146 @@ ACH_LIST: Dict[str, Tuple[str, str]] = {
     "Секретный дрочер шара":("подсел на 8ball",                           "Вызовов /8ball ≥ 30."),
 }
 
+# бит ачивки в UserStats.ach — её позиция в ACH_LIST (новые ачивки добавлять только в конец)
+_ACH_TITLES: List[str] = list(ACH_LIST)
+_ACH_INDEX: Dict[str, int] = {title: i for i, title in enumerate(_ACH_TITLES)}
+
+def _ach_mask(items) -> int:
+    """Названия или индексы ачивок -> маска; неизвестные названия отбрасываются."""
+    mask = 0
+    for t in items:
+        i = t if isinstance(t, int) else _ACH_INDEX.get(t)
+        if i is not None:
+            mask |= 1 << i
+    return mask
+
+def _ach_bits(mask: int) -> List[int]:
+    return [i for i in range(len(_ACH_TITLES)) if mask >> i & 1]
+
+def _ach_titles(mask: int) -> List[str]:
+    return [_ACH_TITLES[i] for i in _ach_bits(mask)]
+
 # ========= МАЛЫЕ УТИЛИТЫ =========
 def _display_name(u: User) -> str:
     return f"@{u.username}" if u.username else (u.full_name or f"id{u.id}")
 
+def _touch(chat_id: int, active: bool = True):
+    """Пометить чат изменённым — попадёт в ближайший чекпоинт.
+    active=False — служебная правка (загрузка, чистка окон): часы простоя чата не сбрасывает."""
+    _DIRTY_CHATS.add(chat_id)
+    if active and not _JOURNAL_REPLAYING:
+        _CHAT_TOUCHED[chat_id] = time.time()
+
+def _touch_global(*sections: str):
+    _DIRTY_GLOBAL.update(sections)
+
+def _remember_name(uid: int, username: Optional[str], name: str):
+    key = sys.intern(username.lower()) if username else None
+    known_changed = key is not None and KNOWN.get(key) != uid
+    if not known_changed and NAMES.get(uid) == name:
+        return
+    _journal("u", uid, username, name)
+    if known_changed:
+        KNOWN[key] = uid
+        _touch_global("KNOWN")
+    if NAMES.get(uid) != name:
+        global NAMES_VERSION
+        NAMES[uid] = name
+        NAMES_VERSION += 1
+        _touch_global("NAMES")
+
 async def _remember_user(u: Optional[User]):
     if not u:
         return
     if u.username:
-        KNOWN[u.username.lower()] = u.id
-        NAMES[u.id] = f"@{u.username}"
+        _remember_name(u.id, u.username, f"@{u.username}")
     else:
-        NAMES[u.id] = u.full_name or f"id{u.id}"
-
-def _ensure_chat(chat_id: int):
-    NICKS.setdefault(chat_id, {})
-    TAKEN.setdefault(chat_id, set())
-    REP_GIVEN.setdefault(chat_id, {})
-    REP_RECEIVED.setdefault(chat_id, {})
-    REP_POS_GIVEN.setdefault(chat_id, {})
-    REP_NEG_GIVEN.setdefault(chat_id, {})
-    REP_GIVE_TIMES.setdefault(chat_id, {})
-    MSG_COUNT.setdefault(chat_id, {})
-    CHAR_COUNT.setdefault(chat_id, {})
-    NICK_CHANGE_COUNT.setdefault(chat_id, {})
-    EIGHTBALL_COUNT.setdefault(chat_id, {})
-    TRIGGER_HITS.setdefault(chat_id, {})
-    BEER_HITS.setdefault(chat_id, {})
-    LAST_MSG_AT.setdefault(chat_id, {})
-    ADMIN_PLUS_GIVEN.setdefault(chat_id, {})
-    ADMIN_MINUS_GIVEN.setdefault(chat_id, {})
-    ACHIEVEMENTS.setdefault(chat_id, {})
+        _remember_name(u.id, None, u.full_name or f"id{u.id}")
+
+def _set_title(chat_id: int, title: str):
+    if CHAT_TITLES.get(chat_id) != title:
+        _journal("ti", chat_id, title)
+        CHAT_TITLES[chat_id] = title
+        _touch_global("CHAT_TITLES")
+
+def _ensure_chat(chat_id: int) -> ChatState:
+    st = CHATS.get(chat_id)
+    if st is not None:
+        return st
+    # не в памяти: выгружен простаивающим или (при ленивом хранилище) ещё не поднят
+    stored = _thaw_chat(chat_id) if chat_id in _COLD_CHATS else STORAGE.load_chat(chat_id)
+    if stored is not None:
+        _install_chat(chat_id, stored)
+        _DIRTY_CHATS.discard(chat_id)  # только что прочитан — писать обратно нечего
+        return CHATS[chat_id]
+    _touch(chat_id)
     TRIGGERS_CFG.setdefault(chat_id, None)  # миграция потом
+    st = CHATS[chat_id] = ChatState()
+    return st
 
 def _cooldown_text(uid: int) -> Optional[str]:
-    now = datetime.now(UTC)
-    last = LAST_NICK.get(uid)
-    if last and now - last < NICK_COOLDOWN:
-        left = int((last + NICK_COOLDOWN - now).total_seconds())
+    left = NICK_LIMIT.wait(LAST_NICK.get(uid), int(datetime.now(UTC).timestamp()))
+    if left:
         return f"подожди ещё ~{left} сек."
     return None
 
-def _mark_nick(uid: int):
-    LAST_NICK[uid] = datetime.now(UTC)
-
-def _inc(d: Dict[int, int], key: int, by: int = 1):
-    d[key] = d.get(key, 0) + by
+def _mark_nick(uid: int, at: Optional[datetime] = None):
+    at = at or datetime.now(UTC)
+    _journal("ln", uid, round(at.timestamp(), 3))
+    NICK_LIMIT.note(LAST_NICK, uid, int(at.timestamp()))
+    _touch_global("LAST_NICK")
+
+def _bump(chat_id: int, section: str, uid: int, by: int) -> int:
+    st = _ensure_chat(chat_id)
+    u = st.user(uid)
+    field = COUNTER_SECTIONS[section]
+    old = getattr(u, field)
+    val = old + by
+    setattr(u, field, val)
+    if field in RANKED_FIELDS:
+        st.scored(uid, field, old, val)
+    part = STATS_PART_OF.get(field)
+    if part:
+        st.bump(part)
+    else:
+        st.bump()
+    _touch(chat_id)
+    return val
+
+def _inc(chat_id: int, section: str, uid: int, by: int = 1) -> int:
+    """Увеличить per-chat счётчик секции (MSG_COUNT, REP_GIVEN, …), вернуть новое значение."""
+    _journal("i", chat_id, section, uid, by)
+    return _bump(chat_id, section, uid, by)
+
+def _count_message(chat_id: int, uid: int, chars: int, at: datetime) -> UserStats:
+    """Учёт сообщения одной записью журнала: last seen + MSG_COUNT + CHAR_COUNT."""
+    _journal("msg", chat_id, uid, chars, round(at.timestamp(), 3))
+    st = _ensure_chat(chat_id)
+    u = st.user(uid)
+    u.last_msg_at = int(at.timestamp())
+    u.msg_count += 1
+    u.char_count += chars
+    st.scored(uid, "msg_count", u.msg_count - 1, u.msg_count)
+    st.bump("msgs")
+    _touch(chat_id)
+    return u
 
 def _name_or_id(uid: int) -> str:
     return NAMES.get(uid, f"id{uid}")
 
 def _trigger_allowed(chat_id: int) -> bool:
-    now = datetime.now(UTC)
-    last = LAST_TRIGGER_TIME.get(chat_id)
-    if last and now - last < TRIGGER_COOLDOWN:
-        return False
-    LAST_TRIGGER_TIME[chat_id] = now
-    return True
+    return not TRIGGER_LIMIT.admit(LAST_TRIGGER_TIME, chat_id, int(datetime.now(UTC).timestamp()))
 
 def _achieve(chat_id: int, user_id: int, title: str) -> bool:
-    got = ACHIEVEMENTS.setdefault(chat_id, {}).setdefault(user_id, set())
-    if title in got:
+    st = _ensure_chat(chat_id)
+    u = st.user(user_id)
+    i = _ACH_INDEX.get(title)
+    if i is None or u.ach >> i & 1:
         return False
-    got.add(title)
+    _journal("a", chat_id, user_id, title)
+    u.ach |= 1 << i
+    st.bump("ach")
+    _touch(chat_id)
     return True
 
 # ========= АДМИНЫ / ALLOWLIST =========
@@ -345,122 +912,603 @@ def _allowed_chat(chat_id: int) -> bool:
     return chat_id in ALLOW_CHATS
 
 # ========= СЕРИАЛИЗАЦИЯ/БЭКАП =========
+# порядок секций в экспорте (совпадает с историческим форматом state_backup.json)
+STATE_SECTIONS: Tuple[str, ...] = (
+    "ALLOW_CHATS", "CHAT_TITLES", "NICKS", "TAKEN", "LAST_NICK", "KNOWN", "NAMES",
+    "REP_GIVEN", "REP_RECEIVED", "REP_POS_GIVEN", "REP_NEG_GIVEN", "REP_GIVE_TIMES",
+    "MSG_COUNT", "CHAR_COUNT", "NICK_CHANGE_COUNT", "EIGHTBALL_COUNT", "TRIGGER_HITS", "BEER_HITS",
+    "LAST_MSG_AT", "ADMIN_PLUS_GIVEN", "ADMIN_MINUS_GIVEN", "ACHIEVEMENTS", "TRIGGERS_CFG",
+    "TRIGGER_STATS",
+)
+# per-chat секции, ключи которых — не user id
+NON_USER_SECTIONS = ("TAKEN", "TRIGGERS_CFG", "TRIGGER_STATS")
+
+GLOBAL_STORES = {"ALLOW_CHATS": ALLOW_CHATS, "CHAT_TITLES": CHAT_TITLES, "LAST_NICK": LAST_NICK,
+                 "KNOWN": KNOWN, "NAMES": NAMES}
+def _copy_global(section: str):
+    store = GLOBAL_STORES[section]
+    if isinstance(store, TieredMap):
+        return store.copy()  # сама таблица читается при кодировании, уже в воркере
+    if section == "LAST_NICK":
+        return {uid: ring[-1] for uid, ring in store.items() if ring}  # epoch последней смены
+    return tuple(store) if section == "ALLOW_CHATS" else dict(store)
+
+def _install_global(section: str, raw):
+    store = GLOBAL_STORES[section]
+    store.clear()
+    if section == "LAST_NICK" and raw:
+        raw = {uid: NICK_LIMIT.ring((ts,)) for uid, ts in raw.items()}
+    store.update(raw)
+
+def _encode_global(section: str, raw):
+    """Сырой вид -> исторический JSON (экспорт)."""
+    if section == "ALLOW_CHATS":
+        return list(raw)
+    if section == "LAST_NICK":
+        return {str(k): _from_ts(v).isoformat() for k, v in raw.items()}
+    if section == "KNOWN":
+        return dict(raw.items())
+    return {str(k): v for k, v in raw.items()}
+
+def _decode_global(section: str, val):
+    if section == "ALLOW_CHATS":
+        return tuple(val)
+    if section == "LAST_NICK":
+        return {int(k): _epoch(datetime.fromisoformat(v)) for k, v in val.items()}
+    if section == "KNOWN":
+        return {k: int(v) for k, v in val.items()}
+    return {int(k): v for k, v in val.items()}
+
+def _serialize_global(section: str):
+    return _encode_global(section, _copy_global(section))
+
+def _known_chat_ids() -> Set[int]:
+    return set(CHATS) | set(TRIGGERS_CFG) | _COLD_CHATS
+
+def _copy_chat(cid: int) -> dict:
+    """Per-chat секции исторического формата (время — epoch-секунды, ачивки — маской);
+    присутствуют только те, где чат реально есть. TAKEN выводится из ников."""
+    if cid in _COLD_CHATS:
+        return _read_cold(cid)  # выгружен — берём с диска, в память не поднимаем
+    out = {}
+    st = CHATS.get(cid)
+    if st is not None:
+        nicks, last, ach = {}, {}, {}
+        counters = {section: {} for section in COUNTER_SECTIONS}
+        for uid, u in st.users.items():
+            if u.nick:
+                nicks[uid] = u.nick
+            for section, field in COUNTER_SECTIONS.items():
+                v = getattr(u, field)
+                if v:
+                    counters[section][uid] = v
+            if u.last_msg_at:
+                last[uid] = u.last_msg_at
+            if u.ach:
+                ach[uid] = u.ach
+        times = {uid: tuple(ring) for uid, ring in st.rep_rings.items() if ring}
+        out = {"NICKS": nicks, "TAKEN": tuple(set(nicks.values())), **counters,
+               "REP_GIVE_TIMES": times, "LAST_MSG_AT": last, "ACHIEVEMENTS": ach,
+               "TRIGGER_STATS": st.trig.by_id()}
+    if cid in TRIGGERS_CFG:
+        out["TRIGGERS_CFG"] = _trigger_refs(TRIGGERS_CFG[cid])
+    return out
+
+def _trigger_refs(cfg: Optional[List[TriggerCfg]]) -> Optional[list]:
+    """Конфиг триггеров -> сырой вид: дефолтный — {"ref": id} плюс только изменённые поля."""
+    if cfg is None:
+        return None
+    out = []
+    for t in cfg:
+        base = DEFAULT_TRIGGERS_BY_ID.get(t.get("id"))
+        if base is None:
+            out.append(dict(t))
+        else:
+            out.append({"ref": base["id"], **{k: v for k, v in t.items() if base.get(k) != v}})
+    return out
+
+def _resolve_triggers(raw: Optional[list]) -> Optional[List[TriggerCfg]]:
+    """Сырой вид (ссылки или старые полные копии дефолтов) -> конфиг триггеров.
+    Неизменённый дефолт становится общим объектом из DEFAULT_TRIGGERS."""
+    if raw is None:
+        return None
+    out = []
+    for t in raw:
+        base = DEFAULT_TRIGGERS_BY_ID.get(t.get("ref", t.get("id")))
+        if base is None:
+            if "ref" not in t:  # свой триггер чата; ссылку на убранный из кода дефолт — выкидываем
+                out.append(TriggerCfg(t))
+            continue
+        over = {k: v for k, v in t.items() if k != "ref" and base.get(k) != v}
+        out.append(TriggerCfg({**base, **over}) if over else base)
+    return out
+
+def _own_trigger(chat_id: int, idx: int) -> TriggerCfg:
+    """Триггер чата для правки: общий дефолт сначала копируется в чат."""
+    items = TRIGGERS_CFG[chat_id]
+    if items[idx] is DEFAULT_TRIGGERS_BY_ID.get(items[idx].get("id")):
+        items[idx] = TriggerCfg(dict(items[idx]))
+    return items[idx]
+
+def _chat_stores(raw: dict) -> Tuple[ChatState, Optional[list]]:
+    """Сырой вид чата -> (ChatState, конфиг триггеров). Годится для воркера."""
+    users: Dict[int, UserStats] = {}
+
+    def user(uid: int) -> UserStats:
+        u = users.get(uid)
+        if u is None:
+            u = users[uid] = UserStats()
+        return u
+
+    for uid, nick in raw.get("NICKS", {}).items():
+        user(uid).nick = nick
+    for section, field in COUNTER_SECTIONS.items():
+        for uid, v in raw.get(section, {}).items():
+            setattr(user(uid), field, v)
+    for uid, ts in raw.get("LAST_MSG_AT", {}).items():
+        user(uid).last_msg_at = ts
+    for uid, mask in raw.get("ACHIEVEMENTS", {}).items():
+        user(uid).ach = mask
+    rings = {uid: REP_LIMIT.ring(arr) for uid, arr in raw.get("REP_GIVE_TIMES", {}).items() if arr}
+    return ChatState(users, rings, raw.get("TRIGGER_STATS")), _resolve_triggers(raw.get("TRIGGERS_CFG"))
+
+def _swap_chat(cid: int, built: Tuple[ChatState, Optional[list]]):
+    """Подменить чат целиком: только присваивание ссылок."""
+    CHATS[cid], TRIGGERS_CFG[cid] = built
+    TRIGGERS_COMPILED.pop(cid, None)  # скомпилируются при первом сообщении
+    _COLD_CHATS.discard(cid)
+    _touch(cid, active=False)  # подъём/импорт — не активность: простой считается по сообщениям
+
+def _install_chat(cid: int, raw: dict):
+    _swap_chat(cid, _chat_stores(raw))
+
+def _encode_chat(raw: dict) -> dict:
+    """Сырой вид -> исторический JSON (экспорт)."""
+    def iso(ts): return _from_ts(ts).isoformat()
+
+    out = {}
+    for section, val in raw.items():
+        if section == "NICKS":
+            out[section] = {str(uid): nick for uid, nick in val.items()}
+        elif section == "TAKEN":
+            out[section] = list(val)
+        elif section in COUNTER_SECTIONS:
+            out[section] = {str(uid): int(v) for uid, v in val.items()}
+        elif section == "REP_GIVE_TIMES":
+            out[section] = {str(uid): [iso(t) for t in arr] for uid, arr in val.items()}
+        elif section == "LAST_MSG_AT":
+            out[section] = {str(uid): iso(ts) for uid, ts in val.items()}
+        elif section == "ACHIEVEMENTS":
+            out[section] = {str(uid): _ach_titles(mask) for uid, mask in val.items()}
+        elif section == "TRIGGERS_CFG":
+            # ссылки {"ref": id} — только внутренний формат; в экспорте полные тела, как раньше
+            out[section] = None if val is None else [dict(t) for t in _resolve_triggers(val)]
+        else:
+            out[section] = val
+    return out
+
+def _decode_chat(d: dict) -> dict:
+    def parse_ts(s): return _epoch(datetime.fromisoformat(s))
+
+    raw = {}
+    for section, val in d.items():
+        if section == "NICKS":
+            raw[section] = {int(uid): nick for uid, nick in val.items()}
+        elif section == "TAKEN":
+            raw[section] = tuple(val)
+        elif section in COUNTER_SECTIONS:
+            raw[section] = {int(uid): int(v) for uid, v in val.items()}
+        elif section == "REP_GIVE_TIMES":
+            raw[section] = {int(uid): tuple(parse_ts(t) for t in arr) for uid, arr in val.items()}
+        elif section == "LAST_MSG_AT":
+            raw[section] = {int(uid): parse_ts(v) for uid, v in val.items()}
+        elif section == "ACHIEVEMENTS":
+            raw[section] = {int(uid): _ach_mask(titles) for uid, titles in val.items()}
+        elif section == "TRIGGERS_CFG":
+            raw[section] = val
+        elif section == "TRIGGER_STATS":
+            raw[section] = {tid: [int(v) for v in row] for tid, row in val.items()}
+    return raw
+
+def _serialize_chat(cid: int) -> dict:
+    return _encode_chat(_copy_chat(cid))
+
+def _copy_state() -> dict:
+    """Сырой вид всего состояния (только копии контейнеров) — кодировать можно уже в воркере."""
+    resident = _known_chat_ids()
+    chats = {cid: _copy_chat(cid) for cid in resident}
+    # чаты, которые лежат в хранилище, но ещё не подняты в память
+    for cid in STORAGE.stored_chat_ids() - resident:
+        chats[cid] = STORAGE.load_chat(cid) or {}
+    return {"globals": {s: _copy_global(s) for s in GLOBAL_SECTIONS}, "chats": chats}
+
+def _parts_to_legacy(parts: dict) -> dict:
+    data = {s: {} for s in STATE_SECTIONS}
+    for s, raw in parts["globals"].items():
+        data[s] = _encode_global(s, raw)
+    for cid, raw in parts["chats"].items():
+        for section, val in _encode_chat(raw).items():
+            data[section][str(cid)] = val
+    return data
+
 def _serialize_state() -> dict:
+    return _parts_to_legacy(_copy_state())
+
+def _known_for(uids: Set[int]) -> Dict[str, int]:
+    """Записи KNOWN для этих uid — по текущему @username из NAMES, без прохода по всему KNOWN."""
+    out = {}
+    for uid in uids:
+        name = NAMES.get(uid, "")
+        if name.startswith("@") and KNOWN.get(name[1:].lower()) == uid:
+            out[name[1:].lower()] = uid
+    return out
+
+def _copy_chat_export(chat_id: int) -> dict:
+    """Сырой вид одного чата + только те пользователи, что в нём встречаются."""
+    raw = _copy_chat(chat_id)
+    uids = set()
+    for section, val in raw.items():
+        if section not in NON_USER_SECTIONS:
+            uids.update(val)
     return {
-        "ALLOW_CHATS": list(ALLOW_CHATS),
-        "CHAT_TITLES": {str(k): v for k, v in CHAT_TITLES.items()},
-        "NICKS": {str(cid): {str(uid): nick for uid, nick in per.items()} for cid, per in NICKS.items()},
-        "TAKEN": {str(cid): list(vals) for cid, vals in TAKEN.items()},
-        "LAST_NICK": {str(k): v.isoformat() for k, v in LAST_NICK.items()},
-        "KNOWN": KNOWN,
-        "NAMES": {str(k): v for k, v in NAMES.items()},
-        # репа и счётчики
-        "REP_GIVEN": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in REP_GIVEN.items()},
-        "REP_RECEIVED": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in REP_RECEIVED.items()},
-        "REP_POS_GIVEN": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in REP_POS_GIVEN.items()},
-        "REP_NEG_GIVEN": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in REP_NEG_GIVEN.items()},
-        "REP_GIVE_TIMES": {
-            str(cid): {str(uid): [t.isoformat() for t in arr] for uid, arr in per.items()}
-            for cid, per in REP_GIVE_TIMES.items()
-        },
-        "MSG_COUNT": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in MSG_COUNT.items()},
-        "CHAR_COUNT": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in CHAR_COUNT.items()},
-        "NICK_CHANGE_COUNT": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in NICK_CHANGE_COUNT.items()},
-        "EIGHTBALL_COUNT": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in EIGHTBALL_COUNT.items()},
-        "TRIGGER_HITS": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in TRIGGER_HITS.items()},
-        "BEER_HITS": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in BEER_HITS.items()},
-        "LAST_MSG_AT": {
-            str(cid): {str(uid): dt.isoformat() for uid, dt in per.items()}
-            for cid, per in LAST_MSG_AT.items()
-        },
-        "ADMIN_PLUS_GIVEN": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in ADMIN_PLUS_GIVEN.items()},
-        "ADMIN_MINUS_GIVEN": {str(cid): {str(uid): int(v) for uid, v in per.items()} for cid, per in ADMIN_MINUS_GIVEN.items()},
-        "ACHIEVEMENTS": {
-            str(cid): {str(uid): list(titles) for uid, titles in per.items()}
-            for cid, per in ACHIEVEMENTS.items()
-        },
-        # триггеры
-        "TRIGGERS_CFG": {
-            str(cid): per for cid, per in TRIGGERS_CFG.items()
+        "globals": {
+            "ALLOW_CHATS": (chat_id,) if chat_id in ALLOW_CHATS else (),  # только сам чат — чужие id не утекают
+            "CHAT_TITLES": {chat_id: CHAT_TITLES.get(chat_id, str(chat_id))},
+            "LAST_NICK": {uid: LAST_NICK[uid][-1] for uid in uids if LAST_NICK.get(uid)},
+            "KNOWN": _known_for(uids),
+            "NAMES": {uid: NAMES[uid] for uid in uids if uid in NAMES},
         },
+        "chats": {chat_id: raw},
+    }
+
+def _legacy_to_parts(data: dict) -> dict:
+    """Исторический section-major JSON -> {"seq", "globals", "chats"} в сыром виде."""
+    per_chat: Dict[int, dict] = {}
+    for section in STATE_SECTIONS:
+        if section in GLOBAL_SECTIONS:
+            continue
+        for cid, val in (data.get(section) or {}).items():
+            per_chat.setdefault(int(cid), {})[section] = val
+    return {
+        "seq": int(data.get("JOURNAL_SEQ", 0)),
+        "globals": {s: _decode_global(s, data[s]) for s in GLOBAL_SECTIONS if s in data},
+        "chats": {cid: _decode_chat(d) for cid, d in per_chat.items()},
     }
 
-def _apply_state(data: dict, target_chat_id: Optional[int] = None, only_this_chat: bool = False):
-    def parse_dt(s): return datetime.fromisoformat(s)
-
-    # allowlist и заголовки
-    ALLOW_CHATS.clear(); ALLOW_CHATS.update(set(data.get("ALLOW_CHATS", [])))
-    CHAT_TITLES.clear(); CHAT_TITLES.update({int(k): v for k, v in data.get("CHAT_TITLES", {}).items()})
-
-    if only_this_chat and target_chat_id is not None:
-        cid = str(target_chat_id)
-
-        def get_map(key): return {int(uid): v for uid, v in data.get(key, {}).get(cid, {}).items()}
-        def get_map_i(key): return {int(uid): int(v) for uid, v in data.get(key, {}).get(cid, {}).items()}
-
-        NICKS[target_chat_id] = get_map("NICKS")
-        TAKEN[target_chat_id] = set(data.get("TAKEN", {}).get(cid, []))
-        REP_GIVEN[target_chat_id] = get_map_i("REP_GIVEN")
-        REP_RECEIVED[target_chat_id] = get_map_i("REP_RECEIVED")
-        REP_POS_GIVEN[target_chat_id] = get_map_i("REP_POS_GIVEN")
-        REP_NEG_GIVEN[target_chat_id] = get_map_i("REP_NEG_GIVEN")
-        MSG_COUNT[target_chat_id] = get_map_i("MSG_COUNT")
-        CHAR_COUNT[target_chat_id] = get_map_i("CHAR_COUNT")
-        NICK_CHANGE_COUNT[target_chat_id] = get_map_i("NICK_CHANGE_COUNT")
-        EIGHTBALL_COUNT[target_chat_id] = get_map_i("EIGHTBALL_COUNT")
-        TRIGGER_HITS[target_chat_id] = get_map_i("TRIGGER_HITS")
-        BEER_HITS[target_chat_id] = get_map_i("BEER_HITS")
-        ADMIN_PLUS_GIVEN[target_chat_id] = get_map_i("ADMIN_PLUS_GIVEN")
-        ADMIN_MINUS_GIVEN[target_chat_id] = get_map_i("ADMIN_MINUS_GIVEN")
-        LAST_MSG_AT[target_chat_id] = {int(uid): parse_dt(v) for uid, v in data.get("LAST_MSG_AT", {}).get(cid, {}).items()}
-        REP_GIVE_TIMES[target_chat_id] = {int(uid): [parse_dt(t) for t in arr]
-                                          for uid, arr in data.get("REP_GIVE_TIMES", {}).get(cid, {}).items()}
-        ACHIEVEMENTS[target_chat_id] = {int(uid): set(titles) for uid, titles in data.get("ACHIEVEMENTS", {}).get(cid, {}).items()}
-
-        # триггеры чата
-        TRIGGERS_CFG[target_chat_id] = data.get("TRIGGERS_CFG", {}).get(cid, None)
-        return
-
-    # Полный импорт
-    def nested_int_map(obj): return {int(cid): {int(uid): v for uid, v in per.items()} for cid, per in obj.items()}
-    def nested_int_map_i(obj): return {int(cid): {int(uid): int(v) for uid, v in per.items()} for cid, per in obj.items()}
-
-    NICKS.clear(); NICKS.update(nested_int_map(data.get("NICKS", {})))
-    TAKEN.clear(); TAKEN.update({int(cid): set(vals) for cid, vals in data.get("TAKEN", {}).items()})
-    LAST_NICK.clear(); LAST_NICK.update({int(k): parse_dt(v) for k, v in data.get("LAST_NICK", {}).items()})
-    KNOWN.clear(); KNOWN.update({k: int(v) for k, v in data.get("KNOWN", {}).items()})
-    NAMES.clear(); NAMES.update({int(k): v for k, v in data.get("NAMES", {}).items()})
-
-    REP_GIVEN.clear(); REP_GIVEN.update(nested_int_map_i(data.get("REP_GIVEN", {})))
-    REP_RECEIVED.clear(); REP_RECEIVED.update(nested_int_map_i(data.get("REP_RECEIVED", {})))
-    REP_POS_GIVEN.clear(); REP_POS_GIVEN.update(nested_int_map_i(data.get("REP_POS_GIVEN", {})))
-    REP_NEG_GIVEN.clear(); REP_NEG_GIVEN.update(nested_int_map_i(data.get("REP_NEG_GIVEN", {})))
-    REP_GIVE_TIMES.clear()
-    for cid, per in data.get("REP_GIVE_TIMES", {}).items():
-        REP_GIVE_TIMES[int(cid)] = {int(uid): [parse_dt(t) for t in arr] for uid, arr in per.items()}
-    MSG_COUNT.clear(); MSG_COUNT.update(nested_int_map_i(data.get("MSG_COUNT", {})))
-    CHAR_COUNT.clear(); CHAR_COUNT.update(nested_int_map_i(data.get("CHAR_COUNT", {})))
-    NICK_CHANGE_COUNT.clear(); NICK_CHANGE_COUNT.update(nested_int_map_i(data.get("NICK_CHANGE_COUNT", {})))
-    EIGHTBALL_COUNT.clear(); EIGHTBALL_COUNT.update(nested_int_map_i(data.get("EIGHTBALL_COUNT", {})))
-    TRIGGER_HITS.clear(); TRIGGER_HITS.update(nested_int_map_i(data.get("TRIGGER_HITS", {})))
-    BEER_HITS.clear(); BEER_HITS.update(nested_int_map_i(data.get("BEER_HITS", {})))
-    LAST_MSG_AT.clear()
-    for cid, per in data.get("LAST_MSG_AT", {}).items():
-        LAST_MSG_AT[int(cid)] = {int(uid): parse_dt(v) for uid, v in per.items()}
-    ADMIN_PLUS_GIVEN.clear(); ADMIN_PLUS_GIVEN.update(nested_int_map_i(data.get("ADMIN_PLUS_GIVEN", {})))
-    ADMIN_MINUS_GIVEN.clear(); ADMIN_MINUS_GIVEN.update(nested_int_map_i(data.get("ADMIN_MINUS_GIVEN", {})))
-    ACHIEVEMENTS.clear()
-    for cid, per in data.get("ACHIEVEMENTS", {}).items():
-        ACHIEVEMENTS[int(cid)] = {int(uid): set(titles) for uid, titles in per.items()}
-
-    # триггеры
+def _state_stores(parts: dict) -> dict:
+    return {"globals": parts["globals"], "chats": {cid: _chat_stores(raw) for cid, raw in parts["chats"].items()}}
+
+def _swap_state(built: dict):
+    """Полностью заменить состояние в памяти уже построенными объектами."""
+    for section in GLOBAL_SECTIONS:
+        _install_global(section, built["globals"].get(section, ()))
+    CHATS.clear()
     TRIGGERS_CFG.clear()
-    for cid, arr in data.get("TRIGGERS_CFG", {}).items():
-        TRIGGERS_CFG[int(cid)] = arr
+    TRIGGERS_COMPILED.clear()
+    _COLD_CHATS.clear()
+    for cid, stores in built["chats"].items():
+        _swap_chat(cid, stores)
+    # состояние заменено целиком — кеш чекпоинта больше не валиден
+    _mark_all_dirty()
+
+def _install_state(parts: dict):
+    _swap_state(_state_stores(parts))
+
+# ========= КОМПАКТНЫЙ СНАПШОТ =========
+# Файл/гист: MAGIC | версия формата (1 байт) | кодек (1 байт) | сжатое тело.
+# Тело — компактный JSON: {"format", "seq", "globals", "chats": [[cid, chat], ...]},
+# где chat — колоночная раскладка: "users" — отсортированные uid, каждая per-user
+# секция — массив, выровненный по users (null — записи нет). Время — epoch-секунды,
+# ачивки — индексы в ACH_LIST (новые ачивки добавлять только в конец списка).
+# Версия 1 — исторический indent-2 JSON без заголовка, читается как есть.
+SNAPSHOT_MAGIC = b"TGST"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_CODECS = {"none": 0, "zlib": 1, "lzma": 2}
+# миграции тела: версия -> функция, поднимающая тело до версии +1
+SNAPSHOT_MIGRATIONS: Dict[int, Callable[[dict], dict]] = {}
+
+def _epoch(dt: datetime) -> int:
+    return int(dt.timestamp())
+
+def _pack_global(section: str, raw):
+    if section == "ALLOW_CHATS":
+        return sorted(raw)
+    return [[k, v] for k, v in raw.items()]
+
+def _unpack_global(section: str, val):
+    if isinstance(val, dict):
+        return _decode_global(section, val)  # строка/тело старого формата
+    if section == "ALLOW_CHATS":
+        return tuple(val)
+    return {k: v for k, v in val}
+
+def _pack_chat(raw: dict) -> dict:
+    users = set()
+    for section, val in raw.items():
+        if section not in NON_USER_SECTIONS:
+            users.update(val)
+    users = sorted(users)
+
+    def column(m: dict, conv=None) -> list:
+        if conv is None:
+            return [m.get(u) for u in users]
+        return [conv(m[u]) if u in m else None for u in users]
+
+    out = {"users": users}
+    for section, val in raw.items():
+        if section == "TAKEN" or (not val and section != "TRIGGERS_CFG"):
+            continue  # пустая секция == отсутствующая; TAKEN выводится из NICKS
+        if section in ("TRIGGERS_CFG", "TRIGGER_STATS"):
+            out[section] = val
+        elif section == "REP_GIVE_TIMES":
+            out[section] = column(val, list)
+        elif section == "ACHIEVEMENTS":
+            out[section] = column(val, _ach_bits)
+        else:
+            out[section] = column(val)  # NICKS, LAST_MSG_AT и счётчики
+    return out
+
+def _unpack_chat(obj: dict) -> dict:
+    if "users" not in obj:
+        return _decode_chat(obj)  # строка/тело старого формата
+    users = obj["users"]
+    raw = {}
+    for section, val in obj.items():
+        if section == "users":
+            continue
+        if section == "TAKEN":
+            raw[section] = tuple(val)
+        elif section in ("TRIGGERS_CFG", "TRIGGER_STATS"):
+            raw[section] = val
+        else:
+            pairs = [(u, v) for u, v in zip(users, val) if v is not None]
+            if section == "REP_GIVE_TIMES":
+                raw[section] = {u: tuple(v) for u, v in pairs}
+            elif section == "ACHIEVEMENTS":
+                raw[section] = {u: _ach_mask(v) for u, v in pairs}
+            else:
+                raw[section] = dict(pairs)
+    return raw
+
+def _compress(body: bytes) -> bytes:
+    codec = SNAPSHOT_CODECS.get(SNAPSHOT_CODEC, 1)
+    if codec == 1:
+        body = zlib.compress(body, 6)
+    elif codec == 2:
+        body = lzma.compress(body, preset=6)
+    return SNAPSHOT_MAGIC + bytes((SNAPSHOT_VERSION, codec)) + body
+
+def _decode_snapshot(blob: bytes) -> dict:
+    """Байты снапшота (новый формат или старый JSON) -> {"seq", "globals", "chats"} в сыром виде."""
+    if not blob.startswith(SNAPSHOT_MAGIC):
+        return _legacy_to_parts(json.loads(blob.decode("utf-8")))
+    version, codec = blob[4], blob[5]
+    body = blob[6:]
+    if codec == 1:
+        body = zlib.decompress(body)
+    elif codec == 2:
+        body = lzma.decompress(body)
+    data = json.loads(body.decode("utf-8"))
+    if version > SNAPSHOT_VERSION:
+        raise ValueError(f"snapshot format v{version} is newer than supported v{SNAPSHOT_VERSION}")
+    while version < SNAPSHOT_VERSION:
+        data = SNAPSHOT_MIGRATIONS[version](data)
+        version += 1
+    return {
+        "seq": int(data.get("seq", 0)),
+        "globals": {s: _unpack_global(s, v) for s, v in data.get("globals", {}).items() if s in GLOBAL_SECTIONS},
+        "chats": {int(cid): _unpack_chat(obj) for cid, obj in data.get("chats", [])},
+        "shards": data.get("shards"),  # только в глобальном шарде гиста: список чатов
+    }
+
+# Скомпилированные regex на весь процесс: (pattern, flags) -> Pattern, LRU. Одинаковые триггеры
+# разных чатов (прежде всего дефолтные) компилируются один раз.
+RX_CACHE_MAX = 2048
+_RX_CACHE: "OrderedDict[Tuple[str, int], re.Pattern]" = OrderedDict()
+
+def _rx(pattern: str, flags: int) -> re.Pattern:
+    key = (pattern, flags)
+    pat = _RX_CACHE.get(key)
+    if pat is None:
+        pat = _RX_CACHE[key] = re.compile(pattern, flags)
+        if len(_RX_CACHE) > RX_CACHE_MAX:
+            _RX_CACHE.popitem(last=False)
+    else:
+        _RX_CACHE.move_to_end(key)
+    return pat
+
+# Всё, что не переживёт склейку в одну альтернацию: обратные ссылки и условия (номера групп
+# сдвинутся), именованные группы (конфликт имён), глобальные inline-флаги (в середине — ошибка)
+_UNCOMBINABLE_RX = re.compile(r"\\\d|\(\?P[<=]|\(\?<\w|\(\?\(|\(\?[aiLmsux]+\)")
+
+# Литеральный префильтр: из разобранного regex выводится набор строк, хотя бы одна из которых
+# обязана встретиться в тексте при любом совпадении. Нет ни одной в тексте — regex не запускаем.
+try:
+    from re import _parser as _sre_parse, _constants as _sre_c
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parse, sre_constants as _sre_c
+
+_SRE_REPEATS = {_sre_c.MAX_REPEAT, _sre_c.MIN_REPEAT, getattr(_sre_c, "POSSESSIVE_REPEAT", _sre_c.MAX_REPEAT)}
+LITERALS_MAX_ALTS = 16  # больше альтернатив — проверка подстрок уже не дешевле regex
+
+def _case_fold_table() -> Dict[int, int]:
+    """Символы, которые re.IGNORECASE считает равными помимо lower() (ſ/s, K/k, ς/σ…), -> один представитель."""
+    try:
+        from re._casefix import _EXTRA_CASES as extra
+    except ImportError:
+        try:
+            from sre_compile import _ignorecase_fixes as extra
+        except ImportError:
+            extra = {}
+    table = {}
+    for k, v in extra.items():
+        canon = min((k, *v))
+        for c in (k, *v):
+            if c != canon:
+                table[c] = canon
+    return table
+
+_CASE_FOLD = _case_fold_table()
+# единственный символ, у которого lower() длиннее одной буквы (İ -> i + U+0307); re сводит его к i
+_CASE_PRE = {0x130: "i"}
+
+def _casefold(text: str) -> str:
+    return text.translate(_CASE_PRE).lower().translate(_CASE_FOLD)
+
+def _required_literals(items) -> Optional[frozenset]:
+    """Обязательные литералы подшаблона; None — вывести не удалось."""
+    best = None
+    run: List[str] = []
+
+    def consider(alts: Optional[frozenset]):
+        nonlocal best
+        if not alts or "" in alts or len(alts) > LITERALS_MAX_ALTS:
+            return
+        if best is None or (min(map(len, alts)), -len(alts)) > (min(map(len, best)), -len(best)):
+            best = alts
+
+    for op, av in items:
+        if op == _sre_c.LITERAL:
+            run.append(chr(av))
+            continue
+        if op == _sre_c.AT:
+            continue  # \b, ^, $ ширины не имеют — подряд идущие литералы не разрывают
+        consider(frozenset(["".join(run)]))
+        run = []
+        if op == _sre_c.SUBPATTERN:
+            _, add_flags, del_flags, sub = av
+            if not add_flags and not del_flags:
+                consider(_required_literals(sub))
+        elif op == _sre_c.BRANCH:
+            alts = [_required_literals(b) for b in av[1]]
+            if all(alts):
+                consider(frozenset().union(*alts))
+        elif op in _SRE_REPEATS and av[0] >= 1:
+            consider(_required_literals(av[2]))
+    consider(frozenset(["".join(run)]))
+    return best
+
+def _trigger_literals(pat: re.Pattern) -> Optional[Tuple[Tuple[str, ...], bool]]:
+    """(литералы, сравнивать ли по _casefold) для префильтра или None — тогда только regex."""
+    try:
+        need = _required_literals(_sre_parse.parse(pat.pattern, pat.flags))
+    except Exception:
+        return None
+    if not need:
+        return None
+    icase = bool(pat.flags & re.IGNORECASE)
+    if icase:
+        need = {_casefold(s) for s in need}
+    return tuple(sorted(need)), icase
+
+class TriggerMatcher:
+    """Триггеры чата (список в порядке приоритета) + один общий regex по всем включённым.
+    Сначала литеральный префильтр отбирает кандидатов — обычное сообщение до regex не доходит.
+    Общий regex — проход за один раз: если сработала группа k, раньше k могли сработать
+    только триггеры с меньшим индексом (их совпадение просто дальше по тексту) — их и проверяем;
+    если не сработала ни одна — отдельно гоняем только не вошедшие в общий regex."""
+    __slots__ = ("items", "combined", "solo", "grouped", "lits", "always", "icase")
+
+    def __init__(self, items: List[Tuple[Optional[re.Pattern], List[str], str, bool]]):
+        self.items = items
+        self.solo: List[int] = []  # включённые, но не вошедшие в общий regex
+        self.grouped: Set[int] = set()
+        self.lits: Dict[int, Tuple[Tuple[str, ...], bool]] = {}  # idx -> литералы префильтра
+        self.always: List[int] = []  # включённые без литералов — кандидаты всегда
+        parts = []
+        for idx, (pat, _, _, enabled) in enumerate(items):
+            if not enabled or pat is None:
+                continue
+            lits = _trigger_literals(pat)
+            if lits is None:
+                self.always.append(idx)
+            else:
+                self.lits[idx] = lits
+            if _UNCOMBINABLE_RX.search(pat.pattern) or pat.flags & ~(re.IGNORECASE | re.UNICODE):
+                self.solo.append(idx)
+                continue
+            body = f"(?i:{pat.pattern})" if pat.flags & re.IGNORECASE else f"(?:{pat.pattern})"
+            parts.append(f"(?P<t{idx}>{body})")
+            self.grouped.add(idx)
+        self.icase = any(icase for _, icase in self.lits.values())
+        self.combined: Optional[re.Pattern] = None
+        if parts:
+            try:
+                self.combined = _rx("|".join(parts), 0)
+            except re.error:
+                self.solo = [i for i, it in enumerate(items) if it[3] and it[0] is not None]
+                self.grouped = set()
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def _hit(self, idx: int, text: str) -> bool:
+        return self.items[idx][0].search(text) is not None
+
+    def candidates(self, text: str) -> List[int]:
+        """Включённые триггеры, которые могут сработать (по возрастанию индекса)."""
+        folded = _casefold(text) if self.icase else text
+        out = [idx for idx, (lits, icase) in self.lits.items()
+               if any(s in (folded if icase else text) for s in lits)]
+        if self.always:
+            out = sorted(out + self.always)
+        return out
+
+    def first(self, text: str, stats: Optional[TriggerStats] = None) -> Optional[int]:
+        """Индекс первого по списку сработавшего триггера; stats — куда считать evals/matches/ns."""
+        cand = self.candidates(text)
+        if not cand:
+            return None
+        k = None
+        if stats is not None:
+            for idx in cand:
+                stats.evals[idx] += 1
+        grouped = [idx for idx in cand if idx in self.grouped] if self.combined is not None else ()
+        if grouped:
+            t0 = time.perf_counter_ns()
+            m = self.combined.search(text)
+            if stats is not None:
+                share = (time.perf_counter_ns() - t0) // len(grouped)  # общий проход — поровну
+                for idx in grouped:
+                    stats.ns[idx] += share
+            if m is not None:
+                k = int(m.lastgroup[1:])
+        found = k
+        for idx in cand:
+            if k is not None and idx >= k:
+                break
+            if k is None and grouped and idx in self.grouped:
+                continue  # общий regex уже сказал «нет» за всю группу
+            t0 = time.perf_counter_ns()
+            hit = self._hit(idx, text)
+            if stats is not None:
+                stats.ns[idx] += time.perf_counter_ns() - t0
+            if hit:
+                found = idx
+                break
+        if stats is not None and found is not None:
+            stats.matches[found] += 1
+        return found
+
+    def all(self, text: str) -> List[int]:
+        """Все сработавшие триггеры по порядку (для /testtrigger)."""
+        return [idx for idx in self.candidates(text) if self._hit(idx, text)]
+
+# Чаты только с общими дефолтами (в любом наборе/порядке) делят и сам матчер: ключ — id объектов
+_SHARED_MATCHERS: Dict[Tuple[int, ...], TriggerMatcher] = {}
 
 def _build_compiled_triggers_for_chat(chat_id: int):
     """Перекомпилировать триггеры чата после изменений/миграции."""
     lst = TRIGGERS_CFG.get(chat_id) or []
+    shared = None
+    if all(t is DEFAULT_TRIGGERS_BY_ID.get(t.get("id")) for t in lst):
+        shared = tuple(map(id, lst))
+        if shared in _SHARED_MATCHERS:
+            TRIGGERS_COMPILED[chat_id] = _SHARED_MATCHERS[shared]
+            return
     compiled = []
     for t in lst:
         try:
@@ -469,7 +1517,7 @@ def _build_compiled_triggers_for_chat(chat_id: int):
                 continue
             if t.get("is_regex", True):
                 flags = re.IGNORECASE if t.get("ignore_case", True) else 0
-                pat = re.compile(t.get("pattern",""), flags)
+                pat = _rx(t.get("pattern",""), flags)
                 compiled.append((pat, t.get("answers", []), t.get("name",""), True))
             else:
                 # простая фраза: соберём regex c учётом границ/регистра
@@ -477,65 +1525,1140 @@ def _build_compiled_triggers_for_chat(chat_id: int):
                 if t.get("word_boundaries", False):
                     esc = r"\b" + esc + r"\b"
                 flags = re.IGNORECASE if t.get("ignore_case", True) else 0
-                pat = re.compile(esc, flags)
+                pat = _rx(esc, flags)
                 compiled.append((pat, t.get("answers", []), t.get("name",""), True))
         except Exception:
-            # невалидный триггер — пропускаем
-            continue
-    TRIGGERS_COMPILED[chat_id] = compiled
+            # невалидный триггер — не матчится, но держит место: индексы совпадают с TRIGGERS_CFG
+            compiled.append((None, t.get("answers", []), t.get("name",""), False))
+    TRIGGERS_COMPILED[chat_id] = TriggerMatcher(compiled)
+    if shared is not None:
+        _SHARED_MATCHERS[shared] = TRIGGERS_COMPILED[chat_id]
+
+def _trigger_stats(chat_id: int, compiled: TriggerMatcher) -> TriggerStats:
+    """Счётчики чата, выровненные по его текущему матчеру."""
+    stats = _ensure_chat(chat_id).trig
+    if stats.source is not compiled:
+        stats.align(compiled, tuple(t.get("id", "") for t in (TRIGGERS_CFG.get(chat_id) or [])))
+    return stats
+
+def _compiled_triggers(chat_id: int) -> TriggerMatcher:
+    """Скомпилированные триггеры чата; компиляция — при первом обращении после загрузки/правки."""
+    compiled = TRIGGERS_COMPILED.get(chat_id)
+    if compiled is None:
+        _build_compiled_triggers_for_chat(chat_id)
+        compiled = TRIGGERS_COMPILED[chat_id]
+    return compiled
+
+# ========= ЗАЩИТА ОТ ТЯЖЁЛЫХ REGEX =========
+# Регэксп в CPython не прервать, а цикл событий один на все чаты, поэтому замеры идут в отдельном
+# процессе с таймаутом: при добавлении — по корпусу обычных и «злых» строк, в рантайме — по сообщению,
+# на котором матчинг вылез за TRIGGER_BUDGET_MS.
+REGEX_CORPUS: List[str] = [
+    "Привет всем! Как дела, кто сегодня после работы на пиво?",
+    "ну я хз, завтра в зал или поспать подольше 😴",
+    "Скинь ссылку https://example.com/path?q=1&x=2 плиз",
+    "ЗАРПЛАТУ ОПЯТЬ ЗАДЕРЖАЛИ!!! 💸💸💸",
+    "ok lol, see you at 8pm — don't forget the snacks",
+    "а" * 4000 + "!",
+    "a" * 4000 + "!",
+    "аб" * 2000,
+    " " * 4000 + "x",
+    "1" * 4000 + "x",
+    "пиво " * 800,
+    "." * 4000,
+    ("ab" * 20 + " ") * 100,
+]
+
+_TIMER_SRC = """
+import json, re, sys, time
+job = json.load(sys.stdin)
+for pattern, flags in job["patterns"]:
+    rx = re.compile(pattern, flags)
+    worst = 0.0
+    for s in job["texts"]:
+        t0 = time.perf_counter()
+        rx.search(s)
+        worst = max(worst, time.perf_counter() - t0)
+    print(worst * 1000, flush=True)
+"""
+
+def _time_patterns(patterns: List[Tuple[str, int]], texts: List[str]) -> List[float]:
+    """Воркер-тред: худшее время (мс) каждого паттерна по текстам, в дочернем процессе.
+    Список короче patterns — следующий за последним замеренным не уложился в TRIGGER_VET_SEC."""
+    job = json.dumps({"patterns": patterns, "texts": texts})
+    try:
+        res = subprocess.run([sys.executable, "-c", _TIMER_SRC], input=job, capture_output=True,
+                             text=True, timeout=TRIGGER_VET_SEC)
+        out = res.stdout
+    except subprocess.TimeoutExpired as e:
+        out = e.stdout or ""
+        if isinstance(out, bytes):
+            out = out.decode("utf-8", "replace")
+    return [float(x) for x in out.split()]
+
+async def _vet_pattern(pattern: str, flags: int) -> Optional[str]:
+    """Проверка нового регэкспа с теми флагами, с которыми он будет работать: None — годится, иначе причина."""
+    try:
+        times = await asyncio.to_thread(_time_patterns, [(pattern, flags)], REGEX_CORPUS)
+    except OSError:
+        return None  # дочерний процесс не запустить — остаётся защита в рантайме
+    if not times:
+        return f"не уложился в {TRIGGER_VET_SEC:g} с на тестовых строках"
+    if times[0] > TRIGGER_VET_MAX_MS:
+        return f"слишком медленный ({times[0]:.0f} мс на строку, лимит {TRIGGER_VET_MAX_MS} мс)"
+    return None
 
-async def cloud_save():
-    payload = _serialize_state()
-    text = json.dumps(payload, ensure_ascii=False, indent=2)
+TRIGGER_OVERRUNS: Dict[Tuple[int, str], int] = {}  # (chat_id, id триггера) -> превышений бюджета
+_BLAME_BUSY: Set[int] = set()  # чаты, по которым уже идёт разбор
 
-    # локальный бэкап
+def _trigger_overrun(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str):
+    """Матчинг вылез за бюджет: в фоне найти виноватые триггеры (по одному разбору на чат)."""
+    if chat_id not in _BLAME_BUSY:
+        _BLAME_BUSY.add(chat_id)
+        context.application.create_task(_blame_triggers(context, chat_id, text))
+
+async def _blame_triggers(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str):
+    try:
+        items = TRIGGERS_CFG.get(chat_id) or []
+        suspects = [(t, pat) for t, (pat, _, _, enabled) in zip(items, _compiled_triggers(chat_id))
+                    if enabled and pat is not None]
+        try:
+            times = await asyncio.to_thread(_time_patterns, [(p.pattern, p.flags) for _, p in suspects], [text])
+        except OSError:
+            return
+        guilty = [t for (t, _), ms in zip(suspects, times) if ms > TRIGGER_BUDGET_MS]
+        if len(times) < len(suspects):
+            guilty.append(suspects[len(times)][0])  # на нём процесс и повис
+        for t in guilty:
+            key = (chat_id, t.get("id", ""))
+            TRIGGER_OVERRUNS[key] = TRIGGER_OVERRUNS.get(key, 0) + 1
+            if TRIGGER_OVERRUNS[key] >= TRIGGER_STRIKES:
+                await _disable_slow_trigger(context, chat_id, t)
+    finally:
+        _BLAME_BUSY.discard(chat_id)
+
+async def _disable_slow_trigger(context: ContextTypes.DEFAULT_TYPE, chat_id: int, t: TriggerCfg):
+    items = TRIGGERS_CFG.get(chat_id) or []
+    idx = next((i for i, x in enumerate(items) if x is t), None)
+    if idx is None:
+        return  # конфиг успели поменять
+    _own_trigger(chat_id, idx)["enabled"] = False
+    _triggers_changed(chat_id)
+    TRIGGER_OVERRUNS.pop((chat_id, t.get("id", "")), None)
+    request_save()
+    to = t.get("added_by") or OWNER_ID
+    if not to:
+        return
+    try:
+        await context.bot.send_message(
+            to,
+            f"⚠️ Триггер «{t.get('name','')}» в чате «{CHAT_TITLES.get(chat_id, chat_id)}» выключен: "
+            f"{TRIGGER_STRIKES} раза матчинг не уложился в {TRIGGER_BUDGET_MS} мс. "
+            f"Упрости паттерн и включи снова: /triggers_toggle {idx + 1}",
+        )
+    except Exception:
+        pass
+
+# ========= HTTP-КЛИЕНТ =========
+# Один долгоживущий клиент с пулом: прогретое соединение к api.github.com / SELF_URL,
+# сохранение — один запрос без повторного TCP+TLS. Открывается в _pre_init, закрывается в _post_shutdown.
+HTTP_TIMEOUTS: Dict[str, httpx.Timeout] = {
+    "gist": httpx.Timeout(12.0, connect=5.0),
+    "gist_raw": httpx.Timeout(30.0, connect=5.0),  # большие шарды по raw_url
+    "keepalive": httpx.Timeout(8.0, connect=4.0),
+}
+_HTTP: Optional[httpx.AsyncClient] = None
+
+def _http() -> httpx.AsyncClient:
+    global _HTTP
+    if _HTTP is None or _HTTP.is_closed:
+        http2 = HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401  (опционально: pip install httpx[http2])
+            except ImportError:
+                http2 = False
+        _HTTP = httpx.AsyncClient(
+            http2=http2,
+            timeout=HTTP_TIMEOUTS["gist"],
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=300.0),
+        )
+    return _HTTP
+
+async def _http_close():
+    global _HTTP
+    if _HTTP is not None:
+        await _HTTP.aclose()
+        _HTTP = None
+
+async def _http_request(method: str, url: str, endpoint: str, **kwargs) -> httpx.Response:
+    """Запрос через общий клиент; 5xx/429 и сетевые ошибки повторяются с джиттером (Retry-After учитывается)."""
+    kwargs.setdefault("timeout", HTTP_TIMEOUTS[endpoint])
+    for attempt in range(HTTP_RETRIES + 1):
+        last = attempt == HTTP_RETRIES
+        try:
+            r = await _http().request(method, url, **kwargs)
+        except httpx.TransportError:
+            if last:
+                raise
+            r = None
+        if r is not None and not (r.status_code == 429 or r.status_code >= 500) or last:
+            return r
+        delay = HTTP_BACKOFF_SEC * (2 ** attempt) * random.uniform(0.5, 1.5)
+        if r is not None and r.headers.get("Retry-After", "").isdigit():
+            delay = max(delay, min(int(r.headers["Retry-After"]), 30))
+        await asyncio.sleep(delay)
+
+# ========= ЧЕКПОИНТЫ =========
+# Закодированные куски снапшота. Между сохранениями перекодируем только грязные
+# чаты/глобальные секции, остальное склеиваем из кеша как есть.
+_CKPT_GLOBAL: Dict[str, str] = {}
+_CKPT_CHATS: Dict[int, str] = {}
+_CKPT_USERS: Set[str] = set()  # KNOWN/NAMES, чьи бакеты в хранилище совпадают с таблицей — пишем только задетые
+_CKPT_GEN = 0          # растёт при сбросе кеша (полная замена состояния)
+_CKPT_PENDING = False  # прошлый чекпоинт не долетел до диска/гиста — повторить
+_SAVE_LOCK = asyncio.Lock()  # сохранения идут строго по одному
+_LAST_SNAPSHOT_BYTES = 0     # размер последнего сжатого снапшота (для /diag)
+_LOCAL_DIGEST: Optional[str] = None  # дайджест снапшота, который сейчас лежит на диске
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _mark_all_dirty():
+    global _CKPT_GEN
+    _CKPT_GEN += 1
+    _CKPT_GLOBAL.clear()
+    _CKPT_CHATS.clear()
+    _CKPT_USERS.clear()
+    _DIRTY_GLOBAL.update(GLOBAL_SECTIONS)
+    _DIRTY_CHATS.update(_known_chat_ids())
+
+def _has_changes() -> bool:
+    return bool(_DIRTY_CHATS or _DIRTY_GLOBAL or _CKPT_PENDING)
+
+def _capture_snapshot() -> dict:
+    """Вызывать под STATE_LOCK: без await и без диска, только копии контейнеров — микросекунды на
+    грязный чат. Выгруженные чаты и справочник попадают ссылками, читаются уже в воркере."""
+    full = SAVE_MODE == "full" and not STORAGE.lazy
+    known = _known_chat_ids()
+    if full:
+        chat_ids, glob = known, set(GLOBAL_SECTIONS)
+    elif STORAGE.lazy:
+        # построчное хранилище: склеивать целый текст не нужно, пишем только грязное
+        chat_ids, glob = set(_DIRTY_CHATS), set(_DIRTY_GLOBAL)
+    else:
+        chat_ids = _DIRTY_CHATS | (known - _CKPT_CHATS.keys())
+        glob = {s for s in GLOBAL_SECTIONS if s in _DIRTY_GLOBAL or s not in _CKPT_GLOBAL}
+    snap = {
+        "gen": _CKPT_GEN,
+        "seq": _JOURNAL_SEQ,
+        "full": full,
+        "chats": {cid: (None if cid not in known else _ColdRef(cid) if cid in _COLD_CHATS else _copy_chat(cid))
+                  for cid in chat_ids},
+        "globals": {s: _capture_global(s) for s in glob},
+        "frag_chats": {} if full or STORAGE.lazy else dict(_CKPT_CHATS),
+        "frag_global": {} if full or STORAGE.lazy else dict(_CKPT_GLOBAL),
+        "gist_pending": set(_GIST_PENDING),
+    }
+    _DIRTY_CHATS.clear(); _DIRTY_GLOBAL.clear()
+    return snap
+
+class _ColdRef:
+    """Выгруженный чат в снимке: файл читается в воркере, не под локом."""
+    __slots__ = ("cid",)
+
+    def __init__(self, cid: int):
+        self.cid = cid
+
+def _chat_frag(raw) -> Optional[str]:
+    """Воркер: закодированный чат снимка. Файл выгруженного — уже готовый фрагмент, не перепаковываем;
+    успели поднять и удалить — ошибка, чекпоинт повторится (чат уже в памяти и попадёт копией)."""
+    if raw is None:
+        return None
+    if isinstance(raw, _ColdRef):
+        return _read_cold_frag(raw.cid)
+    return _dumps(_pack_chat(raw))
+
+def _capture_global(section: str):
+    """Глобальная секция для снимка; справочник — только изменённые строки, таблица читается в воркере.
+    Снапшот целиком (JSON) собирает справочник из таблицы заново, построчное хранилище — только задетые бакеты."""
+    store = GLOBAL_STORES[section]
+    if isinstance(store, TieredMap):
+        return store.take_delta(not STORAGE.lazy or section not in _CKPT_USERS)
+    return _copy_global(section)
+
+def _global_frag(section: str, raw) -> str:
+    """Воркер: закодированная секция снапшота."""
+    if isinstance(raw, UsersDelta):
+        buckets = raw.apply()
+        return "[" + ",".join(buckets[b] for b in sorted(buckets) if buckets[b]) + "]"
+    return _dumps(_pack_global(section, raw))
+
+def _users_landed(snap: dict):
+    """Строки справочника из снимка легли в таблицу и хранилище: снять inflight."""
+    if snap["gen"] != _CKPT_GEN:
+        return  # состояние заменили целиком — и таблицы, и хранилище уже другие
+    for section, raw in snap["globals"].items():
+        if isinstance(raw, UsersDelta):
+            _CKPT_USERS.add(section)
+            store = GLOBAL_STORES[section]
+            for k, v in raw.rows.items():
+                if store.inflight.get(k) == v:
+                    del store.inflight[k]
+
+def _snapshot_body(seq: int, frag_global: Dict[str, str], frag_chats: Dict[int, str], shards: Optional[List[int]] = None) -> bytes:
+    glob = ",".join(f'"{s}":{frag_global[s]}' for s in GLOBAL_SECTIONS if s in frag_global)
+    # порядок детерминирован: одинаковое состояние -> одинаковые байты -> запись пропускается
+    chats = ",".join(f"[{cid},{frag}]" for cid, frag in sorted(frag_chats.items()))
+    body = f'{{"format":{SNAPSHOT_VERSION},"seq":{seq},"globals":{{{glob}}},"chats":[{chats}]'
+    if shards is not None:
+        body += ',"shards":' + _dumps(shards)
+    return _compress((body + "}").encode("utf-8"))
+
+def _encode_snapshot(snap: dict) -> Tuple[bytes, Dict[int, Optional[str]], Dict[str, str], Dict[str, Optional[str]]]:
+    """Чистая функция для воркер-треда: упаковывает только изменённое, склеивает тело и сжимает.
+    Заодно собирает шарды гиста — глобальный и по одному на изменённый/неотправленный чат."""
+    new_global = {s: _global_frag(s, raw) for s, raw in snap["globals"].items()}
+    new_chats = {cid: _chat_frag(raw) for cid, raw in snap["chats"].items()}
+    frag_global = {**snap["frag_global"], **new_global}
+    frag_chats = dict(snap["frag_chats"])
+    for cid, frag in new_chats.items():
+        if frag is None:
+            frag_chats.pop(cid, None)
+        else:
+            frag_chats[cid] = frag
+
+    blob = _snapshot_body(snap["seq"], frag_global, frag_chats)
+
+    shards: Dict[str, Optional[str]] = {}
+    if GIST_TOKEN and GIST_ID:
+        # выгруженные чаты не менялись с выгрузки — их шард в гисте уже актуален (или ждёт в gist_pending)
+        changed = {cid for cid, raw in snap["chats"].items() if not isinstance(raw, _ColdRef)}
+        for cid in snap["gist_pending"] | changed:
+            frag = frag_chats.get(cid)
+            shards[_shard_name(cid)] = None if frag is None else _b64(_snapshot_body(0, {}, {cid: frag}))
+        shards[_shard_name(None)] = _b64(_snapshot_body(snap["seq"], frag_global, {}, sorted(frag_chats)))
+    return blob, new_chats, new_global, shards
+
+def _commit_fragments(snap: dict, new_chats: Dict[int, Optional[str]], new_global: Dict[str, str]):
+    if snap["full"] or snap["gen"] != _CKPT_GEN:
+        return  # пока кодировали, состояние заменили целиком — кеш уже сброшен
+    # справочник не кешируем: следующий снапшот соберёт его из таблицы, а не из второй копии в памяти
+    _CKPT_GLOBAL.update((s, frag) for s, frag in new_global.items() if not isinstance(snap["globals"][s], UsersDelta))
+    for cid, frag in new_chats.items():
+        if frag is None or isinstance(snap["chats"][cid], _ColdRef):
+            _CKPT_CHATS.pop(cid, None)  # выгруженный чат в памяти не держим — каждый раз из файла
+        else:
+            _CKPT_CHATS[cid] = frag
+
+def _write_local(blob: bytes) -> bool:
+    tmp = LOCAL_SNAPSHOT + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())  # журнал обрезается только после того, как снапшот на диске
+        os.replace(tmp, LOCAL_SNAPSHOT)
+        return True
+    except Exception:
+        return False
+
+# ========= ГИСТ: ШАРДЫ =========
+# Удалённая копия — один файл на чат + глобальный (allowlist, заголовки, KNOWN, NAMES,
+# LAST_NICK, seq и список чатов). PATCH несёт только изменившиеся шарды, так что
+# объём выгрузки пропорционален активности, а не всей истории.
+_GIST_PENDING: Set[int] = set()  # чаты, чьи шарды ещё не долетели до гиста
+_GIST_SHARDS: Dict[str, str] = {}  # имя шарда -> дайджест содержимого, которое сейчас лежит в гисте
+_GIST_LEGACY = False             # в гисте лежит старый монолитный GIST_FILENAME — удалить при первой выгрузке
+_GIST_ETAG: Optional[str] = None  # для условного GET на старте
+_GIST_SEQ = -1                    # версия (seq) состояния, лежащего в гисте под этим ETag
+
+def _shard_name(cid: Optional[int]) -> str:
+    base = os.path.splitext(GIST_FILENAME)[0]
+    return f"{base}.global.b64" if cid is None else f"{base}.{cid}.b64"
+
+def _b64(blob: bytes) -> str:
+    return base64.b64encode(blob).decode("ascii")  # gist хранит только текст
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode("ascii")).hexdigest()
+
+def _save_gist_meta():
+    try:
+        with open(GIST_META, "w", encoding="utf-8") as f:
+            json.dump({"etag": _GIST_ETAG, "seq": _GIST_SEQ, "shards": _GIST_SHARDS}, f)
+    except Exception:
+        pass
+
+def _read_gist_meta():
+    global _GIST_ETAG, _GIST_SEQ
     try:
-        with open(LOCAL_BACKUP, "w", encoding="utf-8") as f:
-            f.write(text)
+        with open(GIST_META, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        _GIST_ETAG = meta.get("etag")
+        _GIST_SEQ = int(meta.get("seq", -1))
+        _GIST_SHARDS.clear(); _GIST_SHARDS.update(meta.get("shards") or {})
     except Exception:
         pass
 
+async def _write_local_if_changed(blob: bytes) -> bool:
+    """Байты совпали с лежащими на диске (например, первый чекпоинт после старта) — не пишем."""
+    global _LOCAL_DIGEST
+    digest = hashlib.sha1(blob).hexdigest()
+    if digest == _LOCAL_DIGEST:
+        return True
+    ok = await asyncio.to_thread(_write_local, blob)
+    if ok:
+        _LOCAL_DIGEST = digest
+    return ok
+
+async def _push_gist(shards: Dict[str, Optional[str]], seq: int) -> bool:
+    """PATCH только шардов, которые отличаются от лежащих в гисте; None — удалить файл."""
+    global _GIST_LEGACY, _GIST_ETAG, _GIST_SEQ
     if not (GIST_TOKEN and GIST_ID):
+        return True
+    digests = {name: (None if text is None else _digest(text)) for name, text in shards.items()}
+    files = {}
+    for name, text in shards.items():
+        if text is None and name in _GIST_SHARDS:
+            files[name] = None
+        elif text is not None and _GIST_SHARDS.get(name) != digests[name]:
+            files[name] = {"content": text}
+    if _GIST_LEGACY:
+        files[GIST_FILENAME] = None
+    if not files:
+        return True
+    url = f"https://api.github.com/gists/{GIST_ID}"
+    headers = {"Authorization": f"Bearer {GIST_TOKEN}", "Accept": "application/vnd.github+json"}
+    try:
+        r = await _http_request("PATCH", url, "gist", json={"files": files}, headers=headers)
+    except Exception:
+        return False
+    if r.is_success:
+        _GIST_LEGACY = False
+        _GIST_ETAG = r.headers.get("ETag")
+        _GIST_SEQ = seq
+        for name in files:
+            if digests.get(name) is None:
+                _GIST_SHARDS.pop(name, None)
+            else:
+                _GIST_SHARDS[name] = digests[name]
+        await asyncio.to_thread(_save_gist_meta)
+    return r.is_success
+
+async def cloud_save(force: bool = False):
+    """Снимок под STATE_LOCK, кодирование и запись — уже без лока (обработчики сообщений не ждут)."""
+    global _CKPT_PENDING
+    async with _SAVE_LOCK:
+        async with STATE_LOCK:
+            if not force and not _has_changes():
+                return  # с прошлого чекпоинта ничего не поменялось
+            snap = _capture_snapshot()
+        try:
+            durable, complete = await STORAGE.persist(snap)
+        except BaseException:
+            # грязные метки уже сняты снимком — вернуть, иначе следующий чекпоинт решит, что писать нечего
+            _DIRTY_CHATS.update(snap["chats"])
+            _DIRTY_GLOBAL.update(snap["globals"])
+            _CKPT_PENDING = True
+            raise
+        _CKPT_PENDING = not complete
+        if durable:
+            await _journal_compact(snap["seq"])
+
+# ========= ПЛАНИРОВЩИК СОХРАНЕНИЙ =========
+# Обработчики не ждут запись: request_save() только двигает дедлайн, единственный фоновый
+# цикл склеивает всплеск запросов в один cloud_save. Без запросов цикл сам просыпается
+# с адаптивным интервалом и пишет, только если есть изменения.
+SAVE_LAZY = 0  # можно подождать до планового чекпоинта
+SAVE_SOON = 1  # правка админа: дебаунс, пачка правок — одна выгрузка
+SAVE_NOW = 2   # импорт/сброс/разрастание журнала: как можно скорее (всё равно в фоне)
+
+_SAVE_DUE: Optional[float] = None          # loop.time() ближайшего запланированного сохранения
+_SAVE_BURST_START: Optional[float] = None  # первый запрос текущей пачки — дебаунс не дольше SAVE_MAX_DELAY_SEC
+_SAVE_WAKE: Optional[asyncio.Event] = None
+_SAVE_TASK: Optional[asyncio.Task] = None
+_LAST_SAVE_MONO = 0.0       # loop.time() последнего чекпоинта
+_LAST_SAVE_SEQ = 0          # seq на момент последнего чекпоинта — для оценки темпа мутаций
+_LAST_SAVE_DURATION = 0.0
+_last_save_time: Optional[datetime] = None
+
+def _save_interval() -> float:
+    """Активный чат — чаще (меньше теряем при потере диска), тяжёлый снапшот — реже;
+    запись занимает не больше ~5% времени."""
+    elapsed = max(1.0, asyncio.get_running_loop().time() - _LAST_SAVE_MONO)
+    rate = (_JOURNAL_SEQ - _LAST_SAVE_SEQ) / elapsed  # мутаций в секунду
+    interval = SAVE_MAX_INTERVAL / (1.0 + rate)
+    interval += SAVE_MIN_INTERVAL * (_LAST_SNAPSHOT_BYTES / (1 << 20))
+    interval = max(interval, _LAST_SAVE_DURATION * 20)
+    return min(SAVE_MAX_INTERVAL, max(SAVE_MIN_INTERVAL, interval))
+
+def request_save(priority: int = SAVE_SOON):
+    """Попросить сохранение; возвращается сразу, запись — в фоне."""
+    global _SAVE_DUE, _SAVE_BURST_START
+    try:
+        now = asyncio.get_running_loop().time()
+    except RuntimeError:
+        return  # вне цикла событий (реплей журнала) — сохранит плановый чекпоинт
+    if priority >= SAVE_NOW:
+        due = now
+    elif priority == SAVE_SOON:
+        if _SAVE_BURST_START is None:
+            _SAVE_BURST_START = now
+        due = min(now + SAVE_DEBOUNCE_SEC, _SAVE_BURST_START + SAVE_MAX_DELAY_SEC)
+        if _SAVE_DUE is not None and _SAVE_DUE <= now:
+            due = _SAVE_DUE  # уже назначено «сейчас» — не откладываем
+    else:
+        due = _LAST_SAVE_MONO + _save_interval()
+        if _SAVE_DUE is not None:
+            due = min(due, _SAVE_DUE)
+    _SAVE_DUE = due
+    if _SAVE_WAKE is not None:
+        _SAVE_WAKE.set()
+
+async def _run_save(force: bool = False):
+    global _SAVE_DUE, _SAVE_BURST_START, _LAST_SAVE_MONO, _LAST_SAVE_SEQ, _LAST_SAVE_DURATION, _last_save_time
+    loop = asyncio.get_running_loop()
+    _SAVE_DUE = _SAVE_BURST_START = None  # запросы, пришедшие во время записи, назначат новую
+    started = loop.time()
+    seq = _JOURNAL_SEQ
+    await cloud_save(force)
+    _LAST_SAVE_MONO, _LAST_SAVE_SEQ = loop.time(), seq
+    _LAST_SAVE_DURATION = _LAST_SAVE_MONO - started
+    _last_save_time = datetime.now(UTC)
+
+async def _save_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        deadline = _SAVE_DUE if _SAVE_DUE is not None else _LAST_SAVE_MONO + _save_interval()
+        timeout = deadline - loop.time()
+        if timeout > 0:
+            _SAVE_WAKE.clear()
+            try:
+                await asyncio.wait_for(_SAVE_WAKE.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            continue  # дедлайн мог сдвинуться — пересчитать
+        try:
+            await _run_save()
+        except Exception:
+            await asyncio.sleep(SAVE_MIN_INTERVAL)  # не крутимся на ошибке
+
+def start_save_scheduler():
+    global _SAVE_WAKE, _SAVE_TASK, _LAST_SAVE_MONO, _LAST_SAVE_SEQ
+    loop = asyncio.get_running_loop()
+    _SAVE_WAKE = asyncio.Event()
+    _LAST_SAVE_MONO, _LAST_SAVE_SEQ = loop.time(), _JOURNAL_SEQ
+    _SAVE_TASK = loop.create_task(_save_loop())
+
+async def stop_save_scheduler():
+    """Остановить цикл и гарантированно дописать всё несохранённое."""
+    global _SAVE_TASK
+    if _SAVE_TASK is not None:
+        # идущее сохранение не рвём: дождаться его (оно держит _SAVE_LOCK), потом снять цикл
+        async with _SAVE_LOCK:
+            _SAVE_TASK.cancel()
+        try:
+            await _SAVE_TASK
+        except asyncio.CancelledError:
+            pass
+        _SAVE_TASK = None
+    await journal_flush()
+    await _run_save(force=True)
+
+# ========= ХРАНИЛИЩЕ =========
+class Storage(ABC):
+    """Бэкенд персистентности. lazy=True — чаты поднимаются в память по первому обращению."""
+    lazy = False
+
+    @abstractmethod
+    async def load(self):
+        """Поднять состояние на старте (и накатить журнал)."""
+
+    @abstractmethod
+    async def persist(self, snap: dict) -> Tuple[bool, bool]:
+        """Записать снимок из _capture_snapshot. Возвращает (durable — локально на диске, complete — везде)."""
+
+    def load_chat(self, cid: int) -> Optional[dict]:
+        return None
+
+    def stored_chat_ids(self) -> Set[int]:
+        return set()
+
+    def close(self):
+        pass
+
+class JsonStorage(Storage):
+    """Всё в памяти, снапшот целиком — сжатый state_snapshot.bin + gist (base64)."""
+
+    async def load(self):
+        if STARTUP_MODE == "fast" and GIST_TOKEN and GIST_ID:
+            parts = _read_local_snapshot()
+            if parts is not None:
+                # отвечаем с локального снапшота сразу, гист сверяем параллельно с поллингом
+                _load_snapshot(parts)
+                start_gist_reconcile(parts["seq"])
+                return
+        await cloud_load_if_any()  # локального нет — без гиста отвечать не с чего
+
+    async def persist(self, snap: dict) -> Tuple[bool, bool]:
+        try:
+            blob, new_chats, new_global, shards = await asyncio.to_thread(_encode_snapshot, snap)
+        except Exception:
+            _DIRTY_CHATS.update(snap["chats"]); _DIRTY_GLOBAL.update(snap["globals"])
+            return False, False
+        _commit_fragments(snap, new_chats, new_global)
+        _users_landed(snap)
+        global _LAST_SNAPSHOT_BYTES
+        _LAST_SNAPSHOT_BYTES = len(blob)
+        _GIST_PENDING.update(cid for cid, raw in snap["chats"].items() if not isinstance(raw, _ColdRef))
+        local_ok, gist_ok = await asyncio.gather(_write_local_if_changed(blob), _push_gist(shards, snap["seq"]))
+        if gist_ok:
+            _GIST_PENDING.difference_update(snap["gist_pending"] | new_chats.keys())
+        return local_ok, local_ok and gist_ok
+
+class SqliteStorage(Storage):
+    """Встроенная SQLite (WAL): строка на чат + строка на глобальную секцию, пишем только грязное
+    одной транзакцией. JSON/gist остаются форматом импорта (пустая база) и экспорта."""
+    lazy = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._reader: Optional[sqlite3.Connection] = None  # чтения из цикла событий
+        self._writer: Optional[sqlite3.Connection] = None  # запись из воркер-треда
+        self._write_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _open(self):
+        self._writer = self._connect()
+        self._writer.execute("CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        self._writer.execute("CREATE TABLE IF NOT EXISTS globals (name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._reader = self._connect()
+
+    def _read_globals(self) -> Dict[str, str]:
+        return dict(self._reader.execute("SELECT name, data FROM globals").fetchall())
+
+    async def load(self):
+        global _JOURNAL_SEQ
+        await asyncio.to_thread(self._open)
+        rows = await asyncio.to_thread(self._read_globals)
+        if not rows:
+            # пустая база — импортируем из старого JSON/gist, первый чекпоинт запишет всё сюда
+            await cloud_load_if_any()
+            return
+        for section in GLOBAL_SECTIONS:
+            buckets = {int(name.split("#")[1]): text for name, text in rows.items() if name.startswith(section + "#")}
+            if buckets:
+                rows[section] = "[" + ",".join(buckets[b] for b in sorted(buckets)) + "]"
+            if section in rows:
+                _install_global(section, _unpack_global(section, json.loads(rows[section])))
+            if isinstance(GLOBAL_STORES[section], TieredMap) and (buckets or section not in rows):
+                _CKPT_USERS.add(section)  # таблица справочника заполнена ровно бакетами хранилища
+        _JOURNAL_SEQ = int(rows.get("JOURNAL_SEQ", "0"))
+        _replay_journal()  # затронутые журналом чаты поднимутся лениво
+
+    def load_chat(self, cid: int) -> Optional[dict]:
+        if self._reader is None:
+            return None
+        row = self._reader.execute("SELECT data FROM chats WHERE id = ?", (cid,)).fetchone()
+        return _unpack_chat(json.loads(row[0])) if row else None
+
+    def stored_chat_ids(self) -> Set[int]:
+        if self._reader is None:
+            return set()
+        return {r[0] for r in self._reader.execute("SELECT id FROM chats")}
+
+    def _write(self, snap: dict):
+        chats = {cid: _chat_frag(raw) for cid, raw in snap["chats"].items()}
+        upserts = [(cid, frag) for cid, frag in chats.items() if frag is not None]
+        deletes = [(cid,) for cid, frag in chats.items() if frag is None]
+        globs, drops = [], []
+        for s, raw in snap["globals"].items():
+            if isinstance(raw, UsersDelta):
+                # справочник — строкой на бакет «NAMES#17»: пишем только пересобранные
+                buckets = raw.apply()
+                drops.append((s,))
+                globs.extend((f"{s}#{b}", text) for b, text in buckets.items() if text)
+                drops.extend((f"{s}#{b}",) for b, text in buckets.items() if not text)
+            else:
+                globs.append((s, _global_frag(s, raw)))
+        globs.append(("JOURNAL_SEQ", str(snap["seq"])))
+        with self._write_lock:
+            conn = self._writer
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO chats (id, data) VALUES (?, ?)", upserts)
+                conn.executemany("DELETE FROM chats WHERE id = ?", deletes)
+                conn.executemany("DELETE FROM globals WHERE name = ?", drops)
+                conn.executemany("INSERT OR REPLACE INTO globals (name, data) VALUES (?, ?)", globs)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    async def persist(self, snap: dict) -> Tuple[bool, bool]:
+        if self._writer is None:
+            return False, False
+        try:
+            await asyncio.to_thread(self._write, snap)
+            _users_landed(snap)
+            return True, True
+        except Exception:
+            _DIRTY_CHATS.update(snap["chats"]); _DIRTY_GLOBAL.update(snap["globals"])
+            return False, False
+
+    def close(self):
+        with self._write_lock:
+            for conn in (self._reader, self._writer):
+                if conn is not None:
+                    conn.close()
+            self._reader = self._writer = None
+
+STORAGE: Storage = SqliteStorage(SQLITE_PATH) if STORAGE_BACKEND == "sqlite" else JsonStorage()
+
+# ========= ВЫГРУЗКА ПРОСТАИВАЮЩИХ ЧАТОВ =========
+# Чат без правок CHAT_IDLE_DAYS дней пишется в COLD_DIR/<chat_id>.bin (упакованный как в снапшоте,
+# zlib) и удаляется из памяти вместе с конфигом и компилированными триггерами. Для чекпоинтов и
+# экспорта он остаётся «известным» — _copy_chat читает его с диска. Поднимается в _ensure_chat.
+_COLD_CHATS: Set[int] = set()
+_CHAT_TOUCHED: Dict[int, float] = {}  # chat_id -> time.time() последней правки
+COLD_STATS = {"evicted": 0, "evict_ms": 0.0, "thawed": 0, "thaw_ms": 0.0, "corrupt": 0}
+
+def _cold_path(cid: int) -> str:
+    return os.path.join(COLD_DIR, f"{cid}.bin")
+
+def _write_cold(cid: int, raw: dict) -> bool:
+    """Воркер-тред: упаковать и атомарно записать чат на диск."""
+    try:
+        os.makedirs(COLD_DIR, exist_ok=True)
+        tmp = _cold_path(cid) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(zlib.compress(_dumps(_pack_chat(raw)).encode("utf-8"), 6))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, _cold_path(cid))
+        return True
+    except Exception:
+        return False
+
+def _read_cold_frag(cid: int) -> str:
+    with open(_cold_path(cid), "rb") as f:
+        return zlib.decompress(f.read()).decode("utf-8")
+
+def _read_cold(cid: int) -> dict:
+    return _unpack_chat(json.loads(_read_cold_frag(cid)))
+
+def _thaw_chat(cid: int) -> Optional[dict]:
+    """Поднять выгруженный чат. Битый файл уходит в .bad (счётчик в /diag), чат берётся из последнего
+    чекпоинта (хранилище или локальный снапшот), а если нет и его — начинается пустым."""
+    t0 = time.perf_counter()
+    try:
+        raw = _read_cold(cid)
+    except Exception:
+        COLD_STATS["corrupt"] += 1
+        try:
+            os.replace(_cold_path(cid), _cold_path(cid) + ".bad")
+        except OSError:
+            pass
+        _COLD_CHATS.discard(cid)
+        try:
+            if STORAGE.lazy:
+                raw = STORAGE.load_chat(cid)
+            else:
+                raw = ((_read_local_snapshot() or {}).get("chats") or {}).get(cid)
+        except Exception:
+            raw = None
+        return raw
+    _drop_cold(cid)
+    COLD_STATS["thawed"] += 1
+    COLD_STATS["thaw_ms"] += (time.perf_counter() - t0) * 1000
+    return raw
+
+def _idle_since(cid: int, st: ChatState) -> float:
+    """Последняя активность чата: последнее сообщение (переживает рестарт) или правка в этом процессе."""
+    last = max((u.last_msg_at for u in st.users.values()), default=0)
+    return max(last, _CHAT_TOUCHED.get(cid, 0))
+
+def _drop_cold(cid: int):
+    if cid in _COLD_CHATS:
+        _COLD_CHATS.discard(cid)
+        try:
+            os.remove(_cold_path(cid))
+        except OSError:
+            pass
+
+def _evict_chat(cid: int):
+    CHATS.pop(cid, None)
+    _CKPT_CHATS.pop(cid, None)  # закодированная копия тоже освобождается — чекпоинт прочтёт файл
+    TRIGGERS_CFG.pop(cid, None)
+    TRIGGERS_COMPILED.pop(cid, None)
+    LAST_TRIGGER_TIME.pop(cid, None)
+    _CHAT_TOUCHED.pop(cid, None)
+    _COLD_CHATS.add(cid)
+
+async def idle_chats_job(context: ContextTypes.DEFAULT_TYPE):
+    if CHAT_IDLE_DAYS <= 0:
+        return
+    now = time.time()
+    # файлы прошлого процесса: чаты уже подняты из снапшота
+    if os.path.isdir(COLD_DIR):
+        for name in os.listdir(COLD_DIR):
+            stem = name.split(".")[0]
+            if name.endswith(".bad"):
+                continue  # битые оставляем для разбора
+            if not stem.lstrip("-").isdigit() or int(stem) not in _COLD_CHATS:
+                try:
+                    os.remove(os.path.join(COLD_DIR, name))
+                except OSError:
+                    pass
+    idle = [cid for cid, st in CHATS.items()
+            if now - _idle_since(cid, st) >= CHAT_IDLE_DAYS * 86400 and cid not in _DIRTY_CHATS]
+    for cid in idle:
+        t0 = time.perf_counter()
+        st, stamp = CHATS.get(cid), _CHAT_TOUCHED.get(cid)
+        if st is None:
+            continue
+        if not await asyncio.to_thread(_write_cold, cid, _copy_chat(cid)):
+            continue
+        if CHATS.get(cid) is not st or _CHAT_TOUCHED.get(cid) != stamp or cid in _DIRTY_CHATS:
+            continue  # пока писали, чат ожил — остаётся в памяти
+        _evict_chat(cid)
+        COLD_STATS["evicted"] += 1
+        COLD_STATS["evict_ms"] += (time.perf_counter() - t0) * 1000
+
+# ========= ЖУРНАЛ (WAL) =========
+# Каждая мутация между снапшотами — компактная строка [seq, op, ...] в append-only
+# файле, fsync пачкой. На старте записи с seq > JOURNAL_SEQ снапшота накатываются
+# поверх него; после успешного локального снапшота журнал обрезается до хвоста.
+_JOURNAL_SEQ = 0  # монотонный номер последней мутации (он же версия состояния)
+_JOURNAL_BUF: List[str] = []
+_JOURNAL_REPLAYING = False
+_JOURNAL_IO_LOCK = asyncio.Lock()
+_JOURNAL_FLUSH_TASK: Optional[asyncio.Task] = None
+
+def _journal(op: str, *args):
+    global _JOURNAL_SEQ
+    if _JOURNAL_REPLAYING:
+        return
+    _JOURNAL_SEQ += 1
+    if not JOURNAL_ENABLED:
         return
+    _JOURNAL_BUF.append(_dumps([_JOURNAL_SEQ, op, *args]))
+    if len(_JOURNAL_BUF) >= JOURNAL_BATCH:
+        _schedule_journal_flush()
+
+def _schedule_journal_flush():
+    global _JOURNAL_FLUSH_TASK
+    if _JOURNAL_FLUSH_TASK and not _JOURNAL_FLUSH_TASK.done():
+        return
+    try:
+        _JOURNAL_FLUSH_TASK = asyncio.get_running_loop().create_task(journal_flush())
+    except RuntimeError:
+        pass  # вне цикла событий — допишется плановым флашем
+
+def _journal_append(lines: List[str]) -> int:
+    with open(JOURNAL_FILE, "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+async def journal_flush():
+    if not _JOURNAL_BUF:
+        return
+    async with _JOURNAL_IO_LOCK:
+        lines = _JOURNAL_BUF[:]
+        _JOURNAL_BUF.clear()
+        try:
+            size = await asyncio.to_thread(_journal_append, lines)
+        except Exception:
+            _JOURNAL_BUF[:0] = lines  # вернём в голову очереди, попробуем позже
+            return
+    if size >= JOURNAL_COMPACT_BYTES:
+        request_save(SAVE_NOW)  # журнал разросся — сворачиваем его в новый снапшот
+
+def _journal_rewrite(upto: int):
+    """Оставить в журнале только целые записи с seq > upto."""
+    if not os.path.exists(JOURNAL_FILE):
+        return
+    tmp = JOURNAL_FILE + ".tmp"
+    with open(JOURNAL_FILE, "r", encoding="utf-8") as src, open(tmp, "w", encoding="utf-8") as dst:
+        for line in src:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # оборванная при падении строка
+            if rec[0] > upto:
+                dst.write(line if line.endswith("\n") else line + "\n")
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp, JOURNAL_FILE)
+
+def _record_seq(line: str) -> int:
+    return int(line[1:line.index(",")])
+
+async def _journal_compact(upto: int):
+    if not JOURNAL_ENABLED:
+        return
+    async with _JOURNAL_IO_LOCK:
+        # ещё не сброшенное на диск, но уже вошедшее в снапшот писать незачем
+        _JOURNAL_BUF[:] = [line for line in _JOURNAL_BUF if _record_seq(line) > upto]
+        try:
+            await asyncio.to_thread(_journal_rewrite, upto)
+        except Exception:
+            pass
 
+def _from_ts(ts: float) -> datetime:
+    return datetime.fromtimestamp(ts, UTC)
+
+def _apply_record(op: str, a: list):
+    if op == "msg":
+        cid, uid, chars, ts = a
+        _ensure_chat(cid)
+        _count_message(cid, uid, chars, _from_ts(ts))
+    elif op == "i":
+        cid, section, uid, by = a
+        _ensure_chat(cid)
+        _bump(cid, section, uid, by)
+    elif op == "a":
+        _ensure_chat(a[0])
+        _achieve(*a)
+    elif op == "n":
+        _ensure_chat(a[0])
+        _set_nick(*a)
+    elif op == "ln":
+        _mark_nick(a[0], _from_ts(a[1]))
+    elif op == "g":
+        cid, uid, ts = a
+        REP_LIMIT.note(_ensure_chat(cid).rep_rings, uid, int(ts))
+        _touch(cid)
+    elif op == "u":
+        _remember_name(*a)
+    elif op == "ti":
+        _set_title(*a)
+    elif op == "t":
+        cid, cfg = a
+        _ensure_chat(cid)
+        TRIGGERS_CFG[cid] = _resolve_triggers(cfg)
+        TRIGGERS_COMPILED.pop(cid, None)
+        _touch(cid)
+    elif op == "cu":
+        _ensure_chat(a[0])
+        _clear_user_in_chat(*a)
+    elif op == "cc":
+        _clear_chat(*a)
+    elif op == "al":
+        _allow_chat(*a)
+    elif op == "de":
+        _drop_chat(*a)
+    elif op == "im":
+        mode, cid, record = a
+        _apply_import(mode, cid, _parse_import(base64.b64decode(record), mode, cid))
+
+def _replay_journal():
+    """Накатить хвост журнала поверх загруженного снапшота (JOURNAL_SEQ уже выставлен)."""
+    global _JOURNAL_SEQ, _JOURNAL_REPLAYING
+    if not (JOURNAL_ENABLED and os.path.exists(JOURNAL_FILE)):
+        return
+    base = _JOURNAL_SEQ
+    _JOURNAL_REPLAYING = True
+    try:
+        with open(JOURNAL_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec[0] <= _JOURNAL_SEQ:
+                    continue  # уже в снапшоте или дубль после повторного флаша
+                try:
+                    _apply_record(rec[1], rec[2:])
+                except Exception:
+                    pass
+                _JOURNAL_SEQ = rec[0]
+    finally:
+        _JOURNAL_REPLAYING = False
+    # выкинуть уже вошедшее в снапшот и оборванные строки, чтобы новые записи шли с чистой строки
+    _journal_rewrite(base)
+
+def _load_snapshot(parts: dict):
+    """Разобранный снапшот (_decode_snapshot) -> состояние + хвост журнала."""
+    global _JOURNAL_SEQ
+    _install_state(parts)
+    _JOURNAL_SEQ = parts["seq"]
+    _replay_journal()
+    # триггеры компилируются лениво, по чату при первом сообщении (_compiled_triggers)
+
+def _gist_blob(content: str) -> bytes:
+    content = content.strip()
+    if content.startswith("{"):
+        return content.encode("utf-8")  # старый JSON, лежащий в гисте как есть
+    return base64.b64decode(content)
+
+async def _gist_file(name: str, meta: dict) -> bytes:
+    """Содержимое файла гиста; API обрезает большие файлы — тогда докачиваем по raw_url."""
+    if meta.get("truncated"):
+        r = await _http_request("GET", meta["raw_url"], "gist_raw")
+        r.raise_for_status()
+        if name in _GIST_SHARDS:
+            _GIST_SHARDS[name] = _digest(r.text.strip())
+        return _gist_blob(r.text)
+    return _gist_blob(meta.get("content") or "")
+
+async def _fetch_gist_parts(newer_than: int) -> Optional[dict]:
+    """Снапшот из шардов гиста (или старого монолитного файла), если его версия (seq) новее newer_than.
+    newer_than >= 0 — локальный снапшот есть, тогда GET условный: неизменившийся гист не качаем."""
+    global _GIST_LEGACY, _GIST_ETAG, _GIST_SEQ
     url = f"https://api.github.com/gists/{GIST_ID}"
     headers = {"Authorization": f"Bearer {GIST_TOKEN}", "Accept": "application/vnd.github+json"}
-    async with httpx.AsyncClient(timeout=12.0) as client:
+    _read_gist_meta()
+    # 304 безопасен, только если выгруженное под этим ETag не новее локального снапшота
+    if 0 <= newer_than and _GIST_SEQ <= newer_than and _GIST_ETAG:
+        headers["If-None-Match"] = _GIST_ETAG
+    r = await _http_request("GET", url, "gist", headers=headers)
+    if r.status_code == 304:
+        return None  # гист не менялся с нашей последней выгрузки
+    if r.status_code != 200:
+        return None
+    files = r.json().get("files", {})
+    _GIST_ETAG = r.headers.get("ETag")
+    _GIST_SEQ = -1
+    _GIST_LEGACY = GIST_FILENAME in files
+    _GIST_SHARDS.clear()
+    prefix = os.path.splitext(GIST_FILENAME)[0] + "."
+    # дайджесты по листингу, ничего не декодируя; обрезанные — неизвестны, перезапишутся при изменении
+    _GIST_SHARDS.update({name: ("" if meta.get("truncated") else _digest((meta.get("content") or "").strip()))
+                         for name, meta in files.items() if name.startswith(prefix) and name.endswith(".b64")})
+    glob_name = _shard_name(None)
+    if glob_name not in files:
+        if _GIST_LEGACY and (files[GIST_FILENAME].get("content") or files[GIST_FILENAME].get("truncated")):
+            parts = _decode_snapshot(await _gist_file(GIST_FILENAME, files[GIST_FILENAME]))
+            return parts if parts["seq"] > newer_than else None
+        return None
+    parts = _decode_snapshot(await _gist_file(glob_name, files[glob_name]))
+    _GIST_SEQ = parts["seq"]
+    if parts["seq"] <= newer_than:
+        await asyncio.to_thread(_save_gist_meta)
+        return None  # локальный снапшот не старее — шарды чатов даже не качаем
+    names = [_shard_name(cid) for cid in parts["shards"] or []]
+    missing = [n for n in names if n not in files]
+    if missing:
+        # листинг гиста обрезается (~300 файлов): недостающие шарды — напрямую по raw-ссылке.
+        # Без них состояние неполное — лучше провалить загрузку, чем поставить и перезаписать им гист
+        owner = (r.json().get("owner") or {}).get("login")
+        if not owner:
+            raise RuntimeError(f"в листинге гиста нет {len(missing)} шардов")
+        for n in missing:
+            files[n] = {"truncated": True, "raw_url": f"https://gist.githubusercontent.com/{owner}/{GIST_ID}/raw/{n}"}
+            _GIST_SHARDS[n] = ""
+    blobs = await asyncio.gather(*(_gist_file(n, files[n]) for n in names))
+    await asyncio.to_thread(_save_gist_meta)
+    for blob in blobs:
+        parts["chats"].update(_decode_snapshot(blob)["chats"])
+    return parts
+
+def _read_local_snapshot() -> Optional[dict]:
+    """Локальный снапшот: новый формат, затем старый JSON."""
+    global _LOCAL_DIGEST
+    for path in (LOCAL_SNAPSHOT, LOCAL_BACKUP):
         try:
-            await client.patch(url, json={"files": {GIST_FILENAME: {"content": text}}}, headers=headers)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    blob = f.read()
+                parts = _decode_snapshot(blob)
+                if path == LOCAL_SNAPSHOT:
+                    _LOCAL_DIGEST = hashlib.sha1(blob).hexdigest()
+                return parts
         except Exception:
             pass
+    return None
 
 async def cloud_load_if_any():
-    # 1) Gist
+    """Берём более новый (по seq) из локального снапшота и гиста; при равенстве — локальный."""
+    global _LOCAL_DIGEST
+    parts = _read_local_snapshot()
     if GIST_TOKEN and GIST_ID:
-        url = f"https://api.github.com/gists/{GIST_ID}"
-        headers = {"Authorization": f"Bearer {GIST_TOKEN}", "Accept": "application/vnd.github+json"}
-        async with httpx.AsyncClient(timeout=12.0) as client:
+        try:
+            remote = await _fetch_gist_parts(parts["seq"] if parts is not None else -1)
+            if remote is not None:
+                parts = remote
+                _LOCAL_DIGEST = None  # на диске старее — первый чекпоинт перепишет
+        except Exception:
+            pass
+    if parts is not None:
+        _load_snapshot(parts)
+        return
+    # снапшота нет — хотя бы журнал
+    try:
+        _replay_journal()
+    except Exception:
+        pass
+
+# ========= СВЕРКА С ГИСТОМ ПОСЛЕ БЫСТРОГО СТАРТА =========
+_RECONCILE_TASK: Optional[asyncio.Task] = None
+
+def _live_records(since: int) -> List[list]:
+    """Записи журнала, сделанные после загрузки (seq > since): на диске и ещё в буфере."""
+    recs = []
+    if os.path.exists(JOURNAL_FILE):
+        with open(JOURNAL_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec[0] > since:
+                    recs.append(rec)
+    recs.extend(json.loads(line) for line in _JOURNAL_BUF if _record_seq(line) > since)
+    return recs
+
+def _adopt_remote(parts: dict, since: int):
+    """Гист новее: берём его целиком и докатываем то, что успело произойти после старта.
+    Докатанные записи журналируются заново с seq выше всех старых, старые строки выкидываются."""
+    global _JOURNAL_SEQ, _LOCAL_DIGEST, _JOURNAL_REPLAYING
+    # хвост журнала прошлого процесса, не дошедший до гиста (seq в (remote, since]), тоже докатываем
+    live = _live_records(min(since, parts["seq"]))
+    upto = _JOURNAL_SEQ
+    _install_state(parts)
+    _JOURNAL_SEQ = max(parts["seq"], upto)
+    _JOURNAL_BUF.clear()
+    _JOURNAL_REPLAYING = True
+    try:
+        for rec in live:
             try:
-                r = await client.get(url, headers=headers)
-                if r.status_code == 200:
-                    j = r.json()
-                    files = j.get("files", {})
-                    if GIST_FILENAME in files and files[GIST_FILENAME].get("content"):
-                        data = json.loads(files[GIST_FILENAME]["content"])
-                        _apply_state(data, only_this_chat=False)
-                        # перекомпилируем триггеры для всех чатов
-                        for cid in list(TRIGGERS_CFG.keys()):
-                            _build_compiled_triggers_for_chat(cid)
-                        return
+                _apply_record(rec[1], rec[2:])
             except Exception:
-                pass
-    # 2) локальный
+                continue
+            _JOURNAL_SEQ += 1
+            if JOURNAL_ENABLED:
+                _JOURNAL_BUF.append(_dumps([_JOURNAL_SEQ, *rec[1:]]))
+    finally:
+        _JOURNAL_REPLAYING = False
+    if JOURNAL_ENABLED:
+        _journal_rewrite(upto)
+    _LOCAL_DIGEST = None  # на диске старый снапшот — перепишется целиком
+
+async def _reconcile_gist(local_seq: int, since: int):
     try:
-        if os.path.exists(LOCAL_BACKUP):
-            with open(LOCAL_BACKUP, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            _apply_state(data, only_this_chat=False)
-            for cid in list(TRIGGERS_CFG.keys()):
-                _build_compiled_triggers_for_chat(cid)
+        remote = await _fetch_gist_parts(local_seq)
     except Exception:
-        pass
+        return
+    if remote is None:
+        return  # локальный не старее гиста
+    await journal_flush()
+    async with STATE_LOCK:
+        _adopt_remote(remote, since)
+    request_save(SAVE_NOW)
+
+def start_gist_reconcile(local_seq: int):
+    global _RECONCILE_TASK
+    # since — seq сразу после загрузки: всё выше — живые мутации после старта
+    _RECONCILE_TASK = asyncio.get_running_loop().create_task(_reconcile_gist(local_seq, _JOURNAL_SEQ))
 
 # ========= HEALTH / Flask =========
 app = Flask(__name__)
@@ -578,7 +2701,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await _remember_user(update.effective_user)
         if update.effective_chat.type != "private":
             # сохраним название чата
-            CHAT_TITLES[update.effective_chat.id] = update.effective_chat.title or str(update.effective_chat.id)
+            _set_title(update.effective_chat.id, update.effective_chat.title or str(update.effective_chat.id))
         await update.message.reply_text(WELCOME_TEXT, reply_markup=main_keyboard())
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -597,78 +2720,111 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == BTN_HELP:
         await q.message.reply_text(HELP_TEXT, reply_markup=main_keyboard())
     elif data == BTN_STATS:
-        await q.message.reply_text(build_stats_text(update.effective_chat.id), reply_markup=main_keyboard())
+        text, kb = _stats_message(update.effective_chat.id)
+        await q.message.reply_text(text, reply_markup=kb)
+    elif data.startswith(BTN_STATS_PAGE):
+        _, section, page = (data.split(":") + ["0"])[:3]
+        text, kb = _stats_message(update.effective_chat.id, section, int(page) if page.isdigit() else 0)
+        try:
+            await q.message.edit_text(text, reply_markup=kb)
+        except Exception:
+            pass  # та же страница (message is not modified) или сообщение уже удалено
     else:
         await q.message.reply_text("¯\\_(ツ)_/¯ Неизвестная кнопка", reply_markup=main_keyboard())
 
 # ========= ВСПОМОГАТЕЛЬНОЕ: ОЧИСТКИ ПО ЧАТУ/ПОЛЬЗОВАТЕЛЮ =========
 def _clear_user_in_chat(chat_id: int, uid: int):
-    if uid in NICKS.get(chat_id, {}):
-        old = NICKS[chat_id].pop(uid, None)
-        if old:
-            TAKEN.get(chat_id, set()).discard(old)
-    for store in (REP_GIVEN, REP_RECEIVED, REP_POS_GIVEN, REP_NEG_GIVEN,
-                  MSG_COUNT, CHAR_COUNT, NICK_CHANGE_COUNT, EIGHTBALL_COUNT,
-                  TRIGGER_HITS, BEER_HITS, ADMIN_PLUS_GIVEN, ADMIN_MINUS_GIVEN):
-        if uid in store.get(chat_id, {}):
-            store[chat_id].pop(uid, None)
-    if uid in LAST_MSG_AT.get(chat_id, {}):
-        LAST_MSG_AT[chat_id].pop(uid, None)
-    if uid in REP_GIVE_TIMES.get(chat_id, {}):
-        REP_GIVE_TIMES[chat_id].pop(uid, None)
-    if uid in ACHIEVEMENTS.get(chat_id, {}):
-        ACHIEVEMENTS[chat_id].pop(uid, None)
+    _journal("cu", chat_id, uid)
+    _touch(chat_id)
+    st = _ensure_chat(chat_id) if chat_id in _COLD_CHATS else CHATS.get(chat_id)
+    if st is not None:
+        st.drop(uid)
 
 def _clear_chat(chat_id: int):
-    NICKS[chat_id] = {}
-    TAKEN[chat_id] = set()
-    REP_GIVEN[chat_id] = {}
-    REP_RECEIVED[chat_id] = {}
-    REP_POS_GIVEN[chat_id] = {}
-    REP_NEG_GIVEN[chat_id] = {}
-    REP_GIVE_TIMES[chat_id] = {}
-    MSG_COUNT[chat_id] = {}
-    CHAR_COUNT[chat_id] = {}
-    NICK_CHANGE_COUNT[chat_id] = {}
-    EIGHTBALL_COUNT[chat_id] = {}
-    TRIGGER_HITS[chat_id] = {}
-    BEER_HITS[chat_id] = {}
-    LAST_MSG_AT[chat_id] = {}
-    ADMIN_PLUS_GIVEN[chat_id] = {}
-    ADMIN_MINUS_GIVEN[chat_id] = {}
-    ACHIEVEMENTS[chat_id] = {}
+    _journal("cc", chat_id)
+    _touch(chat_id)
+    CHATS[chat_id] = ChatState()
+    _drop_cold(chat_id)
 
 # ========= СТАТИСТИКА =========
-def build_stats_text(chat_id: int) -> str:
-    def top10(d: Dict[int, int]) -> List[Tuple[int, int]]:
-        return sorted(d.items(), key=lambda x: x[1], reverse=True)[:10]
-
-    top = top10(REP_RECEIVED.get(chat_id, {}))
-    top_lines = [f"• {_name_or_id(uid)}: {score}" for uid, score in top] or ["• пока пусто"]
+def _render_rep(st: ChatState) -> str:
+    top = st.board("rep_received").top(10)
+    lines = [f"• {_name_or_id(uid)}: {score}" for uid, score in top] or ["• пока пусто"]
+    return "🏆 Топ-10 по репутации:\n" + "\n".join(lines)
+
+def _render_msgs(st: ChatState) -> str:
+    top = st.board("msg_count").top(10)
+    lines = [f"• {_name_or_id(uid)}: {cnt} смс / {st.users[uid].char_count} симв."
+             for uid, cnt in top] or ["• пока пусто"]
+    return "⌨️ Топ-10 по активности:\n" + "\n".join(lines)
+
+def _render_nicks(st: ChatState, uids: List[int]) -> List[str]:
+    return [f"• {_name_or_id(uid)}: {st.users[uid].nick}" for uid in uids] or ["• пока никому не присвоено"]
+
+def _render_ach(st: ChatState, uids: List[int]) -> List[str]:
+    return [f"• {_name_or_id(uid)}: {', '.join(sorted(_ach_titles(st.users[uid].ach)))}"
+            for uid in uids] or ["• пока ни у кого нет"]
+
+STATS_RENDER: Dict[str, Callable[[ChatState], str]] = {"rep": _render_rep, "msgs": _render_msgs}
+# постраничные разделы: (заголовок, поле UserStats, рендер строк страницы)
+STATS_PAGED: Dict[str, Tuple[str, str, Callable[[ChatState, List[int]], List[str]]]] = {
+    "nicks": ("📝 Текущие ники", "nick", _render_nicks),
+    "ach": ("🏅 Ачивки участников", "ach", _render_ach),
+}
 
-    nick_items = NICKS.get(chat_id, {})
-    nick_lines = [f"• {_name_or_id(uid)}: {nick}" for uid, nick in nick_items.items()] or ["• пока никому не присвоено"]
+def _cached(st: ChatState, key: str, stamp: tuple, build: Callable[[], object]):
+    """Отрендеренное из st.render, если штамп совпал, иначе собрать и запомнить."""
+    hit = st.render.get(key)
+    if hit is not None and hit[0] == stamp:
+        return hit[1]
+    val = build()
+    st.render[key] = (stamp, val)
+    return val
+
+def _stats_part(st: ChatState, part: str) -> str:
+    return _cached(st, part, (st.changed.get(part, 0), NAMES_VERSION), lambda: STATS_RENDER[part](st))
+
+def _stats_order(st: ChatState, part: str) -> List[int]:
+    """Участники раздела по uid — порядок стабилен, границы страниц не прыгают между кликами."""
+    field = STATS_PAGED[part][1]
+    return _cached(st, part + "#order", (st.changed.get(part, 0),),
+                   lambda: sorted(uid for uid, u in st.users.items() if getattr(u, field)))
+
+def _stats_page(st: ChatState, part: str, page: int) -> Tuple[str, int, int]:
+    """Одна страница раздела (рендерится только она) -> (текст, страница, всего страниц)."""
+    head, _, render = STATS_PAGED[part]
+    order = _stats_order(st, part)
+    size = STATS_PAGE_SIZE[part]
+    pages = max(1, -(-len(order) // size))
+    page = min(max(page, 0), pages - 1)
+    lines = _cached(st, f"{part}:{page}", (st.changed.get(part, 0), NAMES_VERSION),
+                    lambda: render(st, order[page * size:(page + 1) * size]))
+    suffix = f" (стр. {page + 1}/{pages})" if pages > 1 else ""
+    return f"{head}{suffix}:\n" + "\n".join(lines), page, pages
+
+def _stats_message(chat_id: int, section: str = "top", page: int = 0) -> Tuple[str, InlineKeyboardMarkup]:
+    """Текст страницы статистики и клавиатура; между правками чата — просто поиск в кеше."""
+    st = _ensure_chat(chat_id)
+    if section not in STATS_SECTIONS:
+        section = "top"
+    if section == "top":
+        page = 0
+    else:
+        last = (len(_stats_order(st, section)) - 1) // STATS_PAGE_SIZE[section]
+        page = min(max(page, 0), max(last, 0))
+    title = CHAT_TITLES.get(chat_id, str(chat_id))
 
-    top_msg = top10(MSG_COUNT.get(chat_id, {}))
-    msg_lines = [f"• {_name_or_id(uid)}: {cnt} смс / {CHAR_COUNT.get(chat_id, {}).get(uid,0)} симв."
-                 for uid, cnt in top_msg] or ["• пока пусто"]
+    def build():
+        if section == "top":
+            body, pg, pages = _stats_part(st, "rep") + "\n\n" + _stats_part(st, "msgs"), 0, 1
+        else:
+            body, pg, pages = _stats_page(st, section, page)
+        return f"{STATS_TITLE} — {title}\n\n" + body, stats_keyboard(section, pg, pages)
 
-    ach_lines = []
-    for uid, titles in ACHIEVEMENTS.get(chat_id, {}).items():
-        if not titles:
-            continue
-        ach_lines.append(f"• {_name_or_id(uid)}: {', '.join(sorted(titles))}")
-    if not ach_lines:
-        ach_lines = ["• пока ни у кого нет"]
+    return _cached(st, f"msg:{section}:{page}", (st.version, NAMES_VERSION, title), build)
 
-    title = CHAT_TITLES.get(chat_id, str(chat_id))
-    return (
-        f"{STATS_TITLE} — {title}\n\n"
-        "🏆 Топ-10 по репутации:\n" + "\n".join(top_lines) + "\n\n"
-        "📝 Текущие ники:\n" + "\n".join(nick_lines) + "\n\n"
-        "⌨️ Топ-10 по активности:\n" + "\n".join(msg_lines) + "\n\n"
-        "🏅 Ачивки участников:\n" + "\n".join(ach_lines)
-    )
+def build_stats_text(chat_id: int) -> str:
+    return _stats_message(chat_id)[0]
 
 # ========= НИКИ =========
 ADJ = ["шальной","хрустящий","лысый","бурлящий","ламповый","коварный","бархатный","дерзкий","мягкотелый",
@@ -685,31 +2841,104 @@ SPICY = ["подозрительный тип","хитрожоп","задорн
          "барон с понтами","сомнительный эксперт","самурай-недоучка","киборг на минималках",
          "пират без лицензии","клоун-пофигист","барсук-бродяга"]
 
-def _make_nick(chat_id: int, prev: Optional[str]) -> str:
-    taken = TAKEN.setdefault(chat_id, set())
-    for _ in range(80):
-        parts = []
-        parts.append(random.choice(SPICY) if random.random() < 0.25 else random.choice(ADJ))
-        parts.append(random.choice(NOUN))
-        if random.random() < 0.85:
-            parts.append(random.choice(TAILS))
-        nick = " ".join(parts)
-        if random.random() < 0.7:
-            nick += " " + random.choice(EMOJIS)
-        if prev and nick == prev:
-            continue
-        if nick in taken:
+# Пространство ников — смешанная система счисления: голова × существительное × хвост × эмодзи
+# (хвост и эмодзи могут отсутствовать). Индекс однозначно задаёт ник и наоборот.
+NICK_HEADS: List[str] = SPICY + ADJ
+NICK_TAILS: List[Optional[str]] = TAILS + [None]
+NICK_EMOJIS: List[Optional[str]] = EMOJIS + [None]
+NICK_SPACE = len(NICK_HEADS) * len(NOUN) * len(NICK_TAILS) * len(NICK_EMOJIS)
+
+def _nick_text(i: int) -> str:
+    i, e = divmod(i, len(NICK_EMOJIS))
+    i, t = divmod(i, len(NICK_TAILS))
+    h, n = divmod(i, len(NOUN))
+    parts = [NICK_HEADS[h], NOUN[n]]
+    if NICK_TAILS[t]:
+        parts.append(NICK_TAILS[t])
+    if NICK_EMOJIS[e]:
+        parts.append(NICK_EMOJIS[e])
+    return " ".join(parts)
+
+def _nick_index(nick: str) -> Optional[int]:
+    """Обратно: ник -> индекс; None — ник не из генератора (старый, импортированный)."""
+    e = len(EMOJIS)
+    for k, emoji in enumerate(EMOJIS):
+        if nick.endswith(" " + emoji):
+            nick, e = nick[:-len(emoji) - 1], k
+            break
+    for h, head in enumerate(NICK_HEADS):
+        if not nick.startswith(head + " "):
             continue
-        return nick
-    return f"{random.choice(ADJ)} {random.choice(NOUN)} {random.choice(TAILS)}"
+        rest = nick[len(head) + 1:]
+        for n, noun in enumerate(NOUN):
+            if rest == noun:
+                t = len(TAILS)
+            elif rest.startswith(noun + " ") and rest[len(noun) + 1:] in _NICK_TAIL_INDEX:
+                t = _NICK_TAIL_INDEX[rest[len(noun) + 1:]]
+            else:
+                continue
+            return ((h * len(NOUN) + n) * len(NICK_TAILS) + t) * len(NICK_EMOJIS) + e
+    return None
 
-def _apply_nick(chat_id: int, user_id: int, new_nick: str):
-    prev = NICKS[chat_id].get(user_id)
-    if prev:
-        TAKEN[chat_id].discard(prev)
-    NICKS[chat_id][user_id] = new_nick
-    TAKEN[chat_id].add(new_nick)
-    _inc(NICK_CHANGE_COUNT[chat_id], user_id)
+_NICK_TAIL_INDEX: Dict[str, int] = {tail: i for i, tail in enumerate(TAILS)}
+
+class NickPool:
+    """Свободные индексы ников — разреженная перестановка Фишера–Йетса: позиции [0, left) свободны,
+    at/where хранят только сдвинутые элементы, поэтому память ~ числу занятых, а выбор — O(1)."""
+    __slots__ = ("left", "at", "where")
+
+    def __init__(self, size: int, taken: Iterable[int] = ()):
+        self.left = size
+        self.at: Dict[int, int] = {}     # позиция -> индекс
+        self.where: Dict[int, int] = {}  # индекс -> позиция
+        for i in taken:
+            self.take(i)
+
+    def _put(self, pos: int, i: int):
+        if pos == i:
+            self.at.pop(pos, None)
+            self.where.pop(i, None)
+        else:
+            self.at[pos] = i
+            self.where[i] = pos
+
+    def _swap(self, p: int, q: int):
+        a, b = self.at.get(p, p), self.at.get(q, q)
+        self._put(p, b)
+        self._put(q, a)
+
+    def take(self, i: int):
+        pos = self.where.get(i, i)
+        if pos < self.left:
+            self.left -= 1
+            self._swap(pos, self.left)
+
+    def release(self, i: int):
+        pos = self.where.get(i, i)
+        if pos >= self.left:
+            self._swap(pos, self.left)
+            self.left += 1
+
+    def pick(self) -> Optional[int]:
+        """Случайный свободный индекс (не занимая его); None — свободных нет."""
+        if not self.left:
+            return None
+        pos = random.randrange(self.left)
+        return self.at.get(pos, pos)
+
+def _make_nick(chat_id: int) -> Optional[str]:
+    return _ensure_chat(chat_id).new_nick()
+
+def _set_nick(chat_id: int, user_id: int, new_nick: str):
+    _journal("n", chat_id, user_id, new_nick)
+    st = _ensure_chat(chat_id)
+    st.set_nick(user_id, new_nick)
+    st.bump("nicks")
+    _touch(chat_id)
+
+def _apply_nick(chat_id: int, user_id: int, new_nick: str) -> int:
+    _set_nick(chat_id, user_id, new_nick)
+    return _inc(chat_id, "NICK_CHANGE_COUNT", user_id)
 
 async def cmd_nick(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if _is_private(update):
@@ -751,14 +2980,16 @@ async def cmd_nick(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_id = initiator.id
         target_name = _display_name(initiator)
 
-    prev = NICKS[chat_id].get(target_id)
-    new_nick = _make_nick(chat_id, prev)
     async with STATE_LOCK:
-        _apply_nick(chat_id, target_id, new_nick)
-        _mark_nick(initiator.id)
-        cnt = NICK_CHANGE_COUNT[chat_id].get(target_id, 0)
-        nick5 = (cnt >= 5 and _achieve(chat_id, target_id, "Никофил ебучий"))
-        nick10 = (cnt >= 10 and _achieve(chat_id, target_id, "Ник-коллекционер"))
+        new_nick = _make_nick(chat_id)  # текущий ник цели занят — повтора не будет
+        if new_nick is not None:
+            cnt = _apply_nick(chat_id, target_id, new_nick)
+            _mark_nick(initiator.id)
+            nick5 = (cnt >= 5 and _achieve(chat_id, target_id, "Никофил ебучий"))
+            nick10 = (cnt >= 10 and _achieve(chat_id, target_id, "Ник-коллекционер"))
+    if new_nick is None:
+        await update.message.reply_text("Свободные ники в этом чате закончились — все комбинации заняты 🤷")
+        return
     if nick5:
         await _announce_achievement(context, chat_id, target_id, "Никофил ебучий")
     if nick10:
@@ -771,6 +3002,32 @@ async def cmd_nick(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(f"{target_name} теперь известен(а) как «{new_nick}»")
 
+# ========= /RANK =========
+async def cmd_rank(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if _is_private(update):
+        if not await _guard_private_access(update, context):
+            return
+    if not update.message:
+        return
+    await _remember_user(update.effective_user)
+    chat_id = update.effective_chat.id
+    st = _ensure_chat(chat_id)
+
+    target = update.effective_user
+    if update.message.reply_to_message and update.message.reply_to_message.from_user:
+        target = update.message.reply_to_message.from_user
+        await _remember_user(target)
+    u = st.users.get(target.id) or UserStats()
+
+    lines = [f"🏆 {_display_name(target)}:"]
+    for field, label, unit in (("rep_received", "по репе", "репы"), ("msg_count", "по активности", "смс")):
+        board = st.board(field)
+        score = getattr(u, field)
+        place = board.rank(score)
+        where = f"#{place} из {len(board.keys)}" if place else "пока вне рейтинга"
+        lines.append(f"• {label}: {where} ({score} {unit})")
+    await update.message.reply_text("\n".join(lines))
+
 # ========= /8BALL =========
 EIGHT_BALL = [
     "Да ✅","Нет ❌","Возможно 🤔","Скорее да, чем нет","Спроси позже 🕐","Сто процентов 💯",
@@ -789,9 +3046,9 @@ async def cmd_8ball(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _ensure_chat(chat_id)
     uid = update.effective_user.id
     async with STATE_LOCK:
-        _inc(EIGHTBALL_COUNT[chat_id], uid)
-        c10 = (EIGHTBALL_COUNT[chat_id].get(uid, 0) >= 10 and _achieve(chat_id, uid, "Шароман долбанный"))
-        c30 = (EIGHTBALL_COUNT[chat_id].get(uid, 0) >= 30 and _achieve(chat_id, uid, "Секретный дрочер шара"))
+        cnt = _inc(chat_id, "EIGHTBALL_COUNT", uid)
+        c10 = (cnt >= 10 and _achieve(chat_id, uid, "Шароман долбанный"))
+        c30 = (cnt >= 30 and _achieve(chat_id, uid, "Секретный дрочер шара"))
     if c10:
         await _announce_achievement(context, chat_id, uid, "Шароман долбанный")
     if c30:
@@ -816,23 +3073,27 @@ async def _announce_achievement(context: ContextTypes.DEFAULT_TYPE, chat_id: int
 
 def _within_limit_and_mark(chat_id: int, giver_id: int) -> Tuple[bool, Optional[int]]:
     now = datetime.now(UTC)
-    per_chat = REP_GIVE_TIMES.setdefault(chat_id, {})
-    arr = per_chat.get(giver_id, [])
-    arr = [t for t in arr if now - t < REP_WINDOW]
-    per_chat[giver_id] = arr
-    if len(arr) >= REP_DAILY_LIMIT:
-        oldest = min(arr)
-        secs = int((oldest + REP_WINDOW - now).total_seconds())
-        return False, max(1, secs)
-    arr.append(now)
-    per_chat[giver_id] = arr
+    st = _ensure_chat(chat_id)
+    left = REP_LIMIT.admit(st.rep_rings, giver_id, int(now.timestamp()))
+    if left:
+        return False, left
+    _journal("g", chat_id, giver_id, round(now.timestamp(), 3))
+    st.bump()
+    _touch(chat_id)
     return True, None
 
+def _triggers_changed(chat_id: int):
+    """Конфиг триггеров чата отредактирован: журнал, чекпоинт, перекомпиляция."""
+    _journal("t", chat_id, _trigger_refs(TRIGGERS_CFG.get(chat_id)))
+    _touch(chat_id)
+    TRIGGERS_COMPILED.pop(chat_id, None)
+
 def _ensure_triggers_migrated(chat_id: int):
     if TRIGGERS_CFG.get(chat_id) is None:
-        # создать из дефолта (копия)
-        TRIGGERS_CFG[chat_id] = [TriggerCfg(dict(t)) for t in DEFAULT_TRIGGERS]
-        _build_compiled_triggers_for_chat(chat_id)
+        # создать из дефолта (ссылки на общие объекты, копия — только при правке)
+        TRIGGERS_CFG[chat_id] = list(DEFAULT_TRIGGERS)
+        _touch(chat_id)
+        TRIGGERS_COMPILED.pop(chat_id, None)
 
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
@@ -868,33 +3129,31 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await _remember_user(msg.from_user)
 
     chat_id = update.effective_chat.id
-    _ensure_chat(chat_id)
-    CHAT_TITLES[chat_id] = update.effective_chat.title or str(chat_id)
+    st = _ensure_chat(chat_id)
+    _set_title(chat_id, update.effective_chat.title or str(chat_id))
 
     # === 0) AFK-ачивки ===
     now = datetime.now(UTC)
     uid = msg.from_user.id
-    prev = LAST_MSG_AT[chat_id].get(uid)
+    prev = st.users[uid].last_msg_at if uid in st.users else 0
     if prev:
-        gap = now - prev
+        gap = now - _from_ts(prev)
         if gap >= timedelta(days=5) and _achieve(chat_id, uid, "Пошёл смотреть коров"):
             await _announce_achievement(context, chat_id, uid, "Пошёл смотреть коров")
         elif gap >= timedelta(days=3) and _achieve(chat_id, uid, "Споткнулся о ***"):
             await _announce_achievement(context, chat_id, uid, "Споткнулся о ***")
-    LAST_MSG_AT[chat_id][uid] = now
 
     # === 1) Счётчики ===
     text = (msg.text or "")
     async with STATE_LOCK:
-        _inc(MSG_COUNT[chat_id], uid)
-        _inc(CHAR_COUNT[chat_id], uid, by=len(text))
-        if CHAR_COUNT[chat_id].get(uid, 0) >= 5000 and _achieve(chat_id, uid, "Клаводробилка"):
+        me = _count_message(chat_id, uid, len(text), now)
+        if me.char_count >= 5000 and _achieve(chat_id, uid, "Клаводробилка"):
             await _announce_achievement(context, chat_id, uid, "Клаводробилка")
-        if CHAR_COUNT[chat_id].get(uid, 0) >= 20000 and _achieve(chat_id, uid, "Словесный понос"):
+        if me.char_count >= 20000 and _achieve(chat_id, uid, "Словесный понос"):
             await _announce_achievement(context, chat_id, uid, "Словесный понос")
-        if MSG_COUNT[chat_id].get(uid, 0) >= 100 and _achieve(chat_id, uid, "Писарь-маховик"):
+        if me.msg_count >= 100 and _achieve(chat_id, uid, "Писарь-маховик"):
             await _announce_achievement(context, chat_id, uid, "Писарь-маховик")
-        if MSG_COUNT[chat_id].get(uid, 0) >= 300 and _achieve(chat_id, uid, "Флудераст"):
+        if me.msg_count >= 300 and _achieve(chat_id, uid, "Флудераст"):
             await _announce_achievement(context, chat_id, uid, "Флудераст")
 
     t = text.strip()
@@ -928,8 +3187,8 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         ok, secs_left = _within_limit_and_mark(chat_id, giver.id)
         if not ok:
-            mins = (secs_left or 60) // 60
-            await msg.reply_text(f"Лимит репутации исчерпан на 24ч (10/10). Попробуй через ~{mins} мин.")
+            mins = -(-secs_left // 60)  # вверх: раньше этого срока всё равно не пустит
+            await msg.reply_text(f"Лимит репутации исчерпан на 24ч ({REP_DAILY_LIMIT}/{REP_DAILY_LIMIT}). Попробуй через {mins} мин.")
             return
 
         if is_plus and target_id == giver.id:
@@ -941,27 +3200,25 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         delta = 1 if is_plus else -1
         async with STATE_LOCK:
-            _inc(REP_RECEIVED[chat_id], target_id, by=delta)
-            _inc(REP_GIVEN[chat_id], giver.id, by=delta)
+            _inc(chat_id, "REP_RECEIVED", target_id, by=delta)
+            _inc(chat_id, "REP_GIVEN", giver.id, by=delta)
             if delta > 0:
-                _inc(REP_POS_GIVEN[chat_id], giver.id)
+                _inc(chat_id, "REP_POS_GIVEN", giver.id)
             else:
-                _inc(REP_NEG_GIVEN[chat_id], giver.id)
+                _inc(chat_id, "REP_NEG_GIVEN", giver.id)
 
         try:
             if await _is_admin(chat_id, target_id, context):
                 if delta > 0:
-                    _inc(ADMIN_PLUS_GIVEN[chat_id], giver.id)
-                    if ADMIN_PLUS_GIVEN[chat_id].get(giver.id, 0) >= 5 and _achieve(chat_id, giver.id, "Подхалим генеральский"):
+                    if _inc(chat_id, "ADMIN_PLUS_GIVEN", giver.id) >= 5 and _achieve(chat_id, giver.id, "Подхалим генеральский"):
                         await _announce_achievement(context, chat_id, giver.id, "Подхалим генеральский")
                 else:
-                    _inc(ADMIN_MINUS_GIVEN[chat_id], giver.id)
-                    if ADMIN_MINUS_GIVEN[chat_id].get(giver.id, 0) >= 3 and _achieve(chat_id, giver.id, "Ужалил короля"):
+                    if _inc(chat_id, "ADMIN_MINUS_GIVEN", giver.id) >= 3 and _achieve(chat_id, giver.id, "Ужалил короля"):
                         await _announce_achievement(context, chat_id, giver.id, "Ужалил короля")
         except Exception:
             pass
 
-        total = REP_RECEIVED[chat_id].get(target_id, 0)
+        total = st.user(target_id).rep_received
         if total >= 20 and _achieve(chat_id, target_id, "Любимчик, сука"):
             await _announce_achievement(context, chat_id, target_id, "Любимчик, сука")
         if total <= -10 and _achieve(chat_id, target_id, "Токсик-магнит"):
@@ -971,12 +3228,13 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if total <= -20 and _achieve(chat_id, target_id, "Опущенный"):
             await _announce_achievement(context, chat_id, target_id, "Опущенный")
 
-        total_gives = REP_POS_GIVEN[chat_id].get(giver.id, 0) + REP_NEG_GIVEN[chat_id].get(giver.id, 0)
+        gs = st.user(giver.id)
+        total_gives = gs.rep_pos_given + gs.rep_neg_given
         if total_gives >= 20 and _achieve(chat_id, giver.id, "Заводила-плюсовик"):
             await _announce_achievement(context, chat_id, giver.id, "Заводила-плюсовик")
-        if REP_POS_GIVEN[chat_id].get(giver.id, 0) >= 10 and _achieve(chat_id, giver.id, "Щедрый засранец"):
+        if gs.rep_pos_given >= 10 and _achieve(chat_id, giver.id, "Щедрый засранец"):
             await _announce_achievement(context, chat_id, giver.id, "Щедрый засранец")
-        if REP_NEG_GIVEN[chat_id].get(giver.id, 0) >= 10 and _achieve(chat_id, giver.id, "Минусатор-маньяк"):
+        if gs.rep_neg_given >= 10 and _achieve(chat_id, giver.id, "Минусатор-маньяк"):
             await _announce_achievement(context, chat_id, giver.id, "Минусатор-маньяк")
 
         sign = "+" if delta > 0 else "-"
@@ -985,27 +3243,31 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # === 3) Триггеры ===
     _ensure_triggers_migrated(chat_id)
-    compiled = TRIGGERS_COMPILED.get(chat_id, [])
-    for idx, (pat, answers, name, enabled) in enumerate(compiled):
-        if not enabled or not pat:
-            continue
-        if pat.search(t) and _trigger_allowed(chat_id):
-            await msg.reply_text(random.choice(answers))
-            _inc(TRIGGER_HITS[chat_id], uid)
-            # спец-учёт "пива" по id триггера
-            try:
-                trig_id = (TRIGGERS_CFG.get(chat_id) or [])[idx].get("id","")
-                if trig_id == "beer":
-                    _inc(BEER_HITS[chat_id], uid)
-                    if BEER_HITS[chat_id].get(uid, 0) >= 5 and _achieve(chat_id, uid, "Пивной сомелье-алкаш"):
-                        await _announce_achievement(context, chat_id, uid, "Пивной сомелье-алкаш")
-                    if BEER_HITS[chat_id].get(uid, 0) >= 20 and _achieve(chat_id, uid, "Пивозавр"):
-                        await _announce_achievement(context, chat_id, uid, "Пивозавр")
-            except Exception:
-                pass
-            if TRIGGER_HITS[chat_id].get(uid, 0) >= 15 and _achieve(chat_id, uid, "Триггер-мейкер"):
-                await _announce_achievement(context, chat_id, uid, "Триггер-мейкер")
-            break
+    compiled = _compiled_triggers(chat_id)
+    tstats = _trigger_stats(chat_id, compiled)
+    t0 = time.perf_counter()
+    idx = compiled.first(t, tstats)
+    if (time.perf_counter() - t0) * 1000 > TRIGGER_BUDGET_MS:
+        _trigger_overrun(context, chat_id, t)
+    if idx is not None and not _trigger_allowed(chat_id):
+        tstats.suppressed[idx] += 1
+    elif idx is not None:
+        tstats.fires[idx] += 1
+        await msg.reply_text(random.choice(compiled.items[idx][1]))
+        hits = _inc(chat_id, "TRIGGER_HITS", uid)
+        # спец-учёт "пива" по id триггера
+        try:
+            trig_id = (TRIGGERS_CFG.get(chat_id) or [])[idx].get("id","")
+            if trig_id == "beer":
+                beer = _inc(chat_id, "BEER_HITS", uid)
+                if beer >= 5 and _achieve(chat_id, uid, "Пивной сомелье-алкаш"):
+                    await _announce_achievement(context, chat_id, uid, "Пивной сомелье-алкаш")
+                if beer >= 20 and _achieve(chat_id, uid, "Пивозавр"):
+                    await _announce_achievement(context, chat_id, uid, "Пивозавр")
+        except Exception:
+            pass
+        if hits >= 15 and _achieve(chat_id, uid, "Триггер-мейкер"):
+            await _announce_achievement(context, chat_id, uid, "Триггер-мейкер")
 
     # === 4) NSFW ===
     if NSFW_RX.search(t):
@@ -1021,6 +3283,24 @@ async def _ensure_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> b
     member = await context.bot.get_chat_member(chat_id, user_id)
     return member.status in ("administrator", "creator")
 
+def _encode_export(parts: dict, basename: str) -> List[Tuple[str, bytes]]:
+    """Воркер-тред: JSON в памяти, большой — в gzip, и нарезка под лимит документа."""
+    body = json.dumps(_parts_to_legacy(parts), ensure_ascii=False, indent=2).encode("utf-8")
+    fname = basename + ".json"
+    if len(body) > EXPORT_GZIP_BYTES:
+        body = gzip.compress(body, 6)
+        fname += ".gz"
+    if len(body) <= EXPORT_CHUNK_BYTES:
+        return [(fname, body)]
+    # части склеиваются обратно побайтно: cat file.part* > file
+    return [(f"{fname}.part{i // EXPORT_CHUNK_BYTES + 1:02d}", body[i:i + EXPORT_CHUNK_BYTES])
+            for i in range(0, len(body), EXPORT_CHUNK_BYTES)]
+
+async def _send_export(update: Update, parts: dict, basename: str):
+    files = await asyncio.to_thread(_encode_export, parts, basename)
+    for fname, blob in files:
+        await update.message.reply_document(InputFile(io.BytesIO(blob), filename=fname))
+
 async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if _is_private(update):
         if not await _guard_private_access(update, context):
@@ -1028,15 +3308,7 @@ async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await _ensure_admin(update, context):
         await update.message.reply_text("Только админ может делать экспорт 🚫")
         return
-    data = _serialize_state()
-    fname = f"export_all.json"
-    try:
-        with open(fname, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        await update.message.reply_document(InputFile(fname))
-    finally:
-        try: os.remove(fname)
-        except Exception: pass
+    await _send_export(update, _copy_state(), "export_all")
 
 async def cmd_export_here(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if _is_private(update):
@@ -1046,47 +3318,70 @@ async def cmd_export_here(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Только админ может делать экспорт 🚫")
         return
     chat_id = update.effective_chat.id
-    snapshot = _serialize_state()
-
-    def only_chat(section):
-        return {str(chat_id): section.get(str(chat_id), {})}
-
-    slim = {
-        "ALLOW_CHATS": list(ALLOW_CHATS),
-        "CHAT_TITLES": {str(chat_id): CHAT_TITLES.get(chat_id, str(chat_id))},
-        "NICKS": {str(chat_id): snapshot["NICKS"].get(str(chat_id), {})},
-        "TAKEN": {str(chat_id): snapshot["TAKEN"].get(str(chat_id), [])},
-        "LAST_NICK": snapshot["LAST_NICK"],
-        "KNOWN": snapshot["KNOWN"],
-        "NAMES": snapshot["NAMES"],
-        "REP_GIVEN": only_chat(snapshot["REP_GIVEN"]),
-        "REP_RECEIVED": only_chat(snapshot["REP_RECEIVED"]),
-        "REP_POS_GIVEN": only_chat(snapshot["REP_POS_GIVEN"]),
-        "REP_NEG_GIVEN": only_chat(snapshot["REP_NEG_GIVEN"]),
-        "REP_GIVE_TIMES": only_chat(snapshot["REP_GIVE_TIMES"]),
-        "MSG_COUNT": only_chat(snapshot["MSG_COUNT"]),
-        "CHAR_COUNT": only_chat(snapshot["CHAR_COUNT"]),
-        "NICK_CHANGE_COUNT": only_chat(snapshot["NICK_CHANGE_COUNT"]),
-        "EIGHTBALL_COUNT": only_chat(snapshot["EIGHTBALL_COUNT"]),
-        "TRIGGER_HITS": only_chat(snapshot["TRIGGER_HITS"]),
-        "BEER_HITS": only_chat(snapshot["BEER_HITS"]),
-        "LAST_MSG_AT": only_chat(snapshot["LAST_MSG_AT"]),
-        "ADMIN_PLUS_GIVEN": only_chat(snapshot["ADMIN_PLUS_GIVEN"]),
-        "ADMIN_MINUS_GIVEN": only_chat(snapshot["ADMIN_MINUS_GIVEN"]),
-        "ACHIEVEMENTS": only_chat(snapshot["ACHIEVEMENTS"]),
-        "TRIGGERS_CFG": {str(chat_id): TRIGGERS_CFG.get(chat_id, [])},
-    }
-
-    fname = f"export_chat_{chat_id}.json"
-    try:
-        with open(fname, "w", encoding="utf-8") as f:
-            json.dump(slim, f, ensure_ascii=False, indent=2)
-        await update.message.reply_document(InputFile(fname))
-    finally:
-        try: os.remove(fname)
-        except Exception: pass
+    _ensure_chat(chat_id)
+    await _send_export(update, _copy_chat_export(chat_id), f"export_chat_{chat_id}")
+
+IMPORT_MODES = ("chat", "merge", "full")
+
+def _merge_chat(cid: int, raw: dict):
+    """Импорт-слияние: счётчики складываются, остальное дополняется — текущее важнее файла."""
+    st = _ensure_chat(cid)
+    for section, field in COUNTER_SECTIONS.items():
+        for uid, v in raw.get(section, {}).items():
+            u = st.user(uid)
+            setattr(u, field, getattr(u, field) + v)
+    st.boards.clear()  # массовая правка — лидерборды проще перестроить
+    st.bump(*STATS_PARTS)
+    st.trig.add(raw.get("TRIGGER_STATS", {}))
+    for uid, nick in raw.get("NICKS", {}).items():
+        if not st.user(uid).nick and not st.nick_taken(nick):
+            st.set_nick(uid, nick)
+    for uid, ts in raw.get("LAST_MSG_AT", {}).items():
+        u = st.user(uid)
+        u.last_msg_at = max(u.last_msg_at, ts)
+    for uid, arr in raw.get("REP_GIVE_TIMES", {}).items():
+        st.rep_rings[uid] = REP_LIMIT.ring(set(st.rep_rings.get(uid, ())) | set(arr))
+    for uid, mask in raw.get("ACHIEVEMENTS", {}).items():
+        st.user(uid).ach |= mask
+    if TRIGGERS_CFG.get(cid) is None and raw.get("TRIGGERS_CFG") is not None:
+        TRIGGERS_CFG[cid] = _resolve_triggers(raw["TRIGGERS_CFG"])
+        TRIGGERS_COMPILED.pop(cid, None)
+    _touch(cid)
+
+def _parse_import(blob: bytes, mode: str, chat_id: int):
+    """Воркер-тред: распаковка, разбор и проверка файла, сборка структур вне лока.
+    Принимает экспорт (JSON, в т.ч. .gz) и бинарный снапшот."""
+    if blob[:2] == b"\x1f\x8b":
+        # потоком и с потолком: gzip-бомба не успеет раздуться в памяти
+        limit = IMPORT_MAX_BYTES * 8
+        blob = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(blob, limit + 1)
+        if len(blob) > limit:
+            raise ValueError("распакованный файл слишком большой")
+    parts = _decode_snapshot(blob)
+    if mode == "full":
+        return _state_stores(parts)
+    chats = parts["chats"]
+    if chat_id in chats:
+        raw = chats[chat_id]
+    elif len(chats) == 1:
+        raw = next(iter(chats.values()))  # экспорт другого чата — переносим сюда
+    else:
+        raise ValueError("в файле нет данных этого чата")
+    return raw if mode == "merge" else _chat_stores(raw)
+
+def _apply_import(mode: str, chat_id: int, built):
+    """Под STATE_LOCK: подставить разобранный импорт (из обработчика или из журнала)."""
+    if mode == "full":
+        _swap_state(built)
+    elif mode == "merge":
+        _merge_chat(chat_id, built)
+    else:
+        _swap_chat(chat_id, built)
+    if mode != "full":
+        _ensure_triggers_migrated(chat_id)
 
 async def cmd_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/import — заменить этот чат, /import merge — сложить счётчики, /import full — всё состояние (владелец)."""
     if _is_private(update):
         if not await _guard_private_access(update, context):
             return
@@ -1096,27 +3391,41 @@ async def cmd_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await _ensure_admin(update, context):
         await update.message.reply_text("Только админ может делать импорт 🚫")
         return
+    # файл с подписью «/import merge» приходит через MessageHandler по подписи — аргументы берём из неё
+    args = (update.message.caption or update.message.text or "").split()[1:]
+    mode = args[0].lower() if args else "chat"
+    if mode not in IMPORT_MODES:
+        await update.message.reply_text("Режимы: /import, /import merge, /import full")
+        return
+    if mode == "full" and update.effective_user.id != OWNER_ID:
+        await update.message.reply_text("Полный импорт — только владелец бота 🚫")
+        return
+    doc = update.message.document
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text(f"Файл больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ ❌")
+        return
     chat_id = update.effective_chat.id
     try:
-        file = await context.bot.get_file(update.message.document)
-        path = f"import_{chat_id}.json"
-        await file.download_to_drive(path)
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        async with STATE_LOCK:
-            _apply_state(data, target_chat_id=chat_id, only_this_chat=True)
-            # перекомпилируем триггеры для этого чата
-            _ensure_triggers_migrated(chat_id)
-            _build_compiled_triggers_for_chat(chat_id)
-            await cloud_save()
-        await update.message.reply_text("Импорт завершён ✅ (только текущий чат)")
-    except json.JSONDecodeError:
-        await update.message.reply_text("Файл не похож на валидный JSON ❌")
+        file = await context.bot.get_file(doc)
+        blob = bytes(await file.download_as_bytearray())
+        if len(blob) > IMPORT_MAX_BYTES:
+            raise ValueError("файл слишком большой")
+        built = await asyncio.to_thread(_parse_import, blob, mode, chat_id)
+        record = await asyncio.to_thread(_b64, blob) if JOURNAL_ENABLED else None
+    except (ValueError, KeyError, TypeError, EOFError, zlib.error, lzma.LZMAError) as e:
+        await update.message.reply_text(f"Файл не похож на валидный экспорт ❌ ({e.__class__.__name__})")
+        return
     except Exception as e:
         await update.message.reply_text(f"Не удалось импортировать: {type(e).__name__}")
-    finally:
-        try: os.remove(path)
-        except Exception: pass
+        return
+    async with STATE_LOCK:
+        _apply_import(mode, chat_id, built)
+        # в журнал — сам файл: при подъёме он разберётся заново на своём месте среди записей
+        _journal("im", mode, chat_id, record)
+    await journal_flush()  # «готово» только после fsync журнала; чекпоинт — в фоне
+    request_save(SAVE_NOW)
+    done = {"chat": "только текущий чат", "merge": "счётчики добавлены к текущим", "full": "всё состояние"}[mode]
+    await update.message.reply_text(f"Импорт завершён ✅ ({done})")
 
 # ========= RESET (АДМИН) =========
 async def cmd_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1130,7 +3439,7 @@ async def cmd_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _ensure_chat(chat_id)
     async with STATE_LOCK:
         _clear_chat(chat_id)
-        await cloud_save()
+    request_save(SAVE_NOW)
     await update.message.reply_text("🔄 История этого чата сброшена админом. Всё начинается заново!")
 
 async def cmd_resetuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1166,7 +3475,7 @@ async def cmd_resetuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     async with STATE_LOCK:
         _clear_user_in_chat(chat_id, target_id)
-        await cloud_save()
+    request_save()
     await update.message.reply_text(f"🔄 Данные пользователя {target_name or _name_or_id(target_id)} очищены админом.")
 
 # ========= ALLOWLIST (ТОЛЬКО OWNER) =========
@@ -1178,10 +3487,9 @@ async def cmd_allowchat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Эту команду нужно вызвать в группе, которую хочешь разрешить.")
         return
     _ensure_chat(chat_id)
-    ALLOW_CHATS.add(chat_id)
-    CHAT_TITLES[chat_id] = update.effective_chat.title or str(chat_id)
-    async with STATE_LOCK:
-        await cloud_save()
+    _allow_chat(chat_id)
+    _set_title(chat_id, update.effective_chat.title or str(chat_id))
+    request_save()
     await update.message.reply_text("✅ Чат добавлен в список разрешённых. Бот активирован.")
 
 async def cmd_denychat(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1191,20 +3499,30 @@ async def cmd_denychat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type not in ("group", "supergroup"):
         await update.message.reply_text("Эту команду нужно вызвать в группе, которую хочешь запретить.")
         return
-    if chat_id in ALLOW_CHATS:
-        ALLOW_CHATS.discard(chat_id)
     async with STATE_LOCK:
-        _clear_chat(chat_id)
-        TRIGGERS_CFG.pop(chat_id, None)
-        TRIGGERS_COMPILED.pop(chat_id, None)
-        CHAT_TITLES.pop(chat_id, None)
-        await cloud_save()
+        _drop_chat(chat_id)
+    request_save(SAVE_NOW)
     await update.message.reply_text("❌ Чат удалён из разрешённых и полностью очищен. Выходим…")
     try:
         await context.bot.leave_chat(chat_id)
     except Exception:
         pass
 
+def _allow_chat(chat_id: int):
+    _journal("al", chat_id)
+    ALLOW_CHATS.add(chat_id)
+    _touch_global("ALLOW_CHATS")
+
+def _drop_chat(chat_id: int):
+    """Запретить чат и стереть все его данные."""
+    _journal("de", chat_id)
+    ALLOW_CHATS.discard(chat_id)
+    _clear_chat(chat_id)
+    TRIGGERS_CFG.pop(chat_id, None)
+    TRIGGERS_COMPILED.pop(chat_id, None)
+    CHAT_TITLES.pop(chat_id, None)
+    _touch_global("ALLOW_CHATS", "CHAT_TITLES")
+
 async def cmd_listchats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if _is_private(update) and update.effective_user.id != OWNER_ID:
         return
@@ -1246,7 +3564,10 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 def _get_admin_target_chat(user_id: int) -> Optional[int]:
     sess = ADMIN_SESS.get(user_id)
-    return sess.get("chat_id") if sess else None
+    chat_id = sess.get("chat_id") if sess else None
+    if chat_id:
+        _ensure_chat(chat_id)  # чат мог быть ещё не поднят из хранилища
+    return chat_id
 
 # ========= ТРИГГЕРЫ: СПИСОК/ТОГГЛ/УДАЛЕНИЕ =========
 def _format_triggers_list(chat_id: int) -> str:
@@ -1254,10 +3575,15 @@ def _format_triggers_list(chat_id: int) -> str:
     items = TRIGGERS_CFG.get(chat_id) or []
     if not items:
         return "Список триггеров пуст."
+    stats = _trigger_stats(chat_id, _compiled_triggers(chat_id))
     lines = []
     for i, t in enumerate(items, start=1):
         status = "✅" if t.get("enabled", True) else "🚫"
         lines.append(f"{i}. {status} {t.get('name','(без имени)')} — ответов: {len(t.get('answers',[]))}")
+        j = i - 1
+        if stats.evals[j]:
+            lines.append(f"    проверок {stats.evals[j]}, совпадений {stats.matches[j]}, ответов {stats.fires[j]}, "
+                         f"кулдаун {stats.suppressed[j]}, {stats.ns[j] / stats.evals[j] / 1000:.0f} мкс/проверку")
     return "Триггеры чата:\n" + "\n".join(lines)
 
 async def cmd_triggers(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1295,10 +3621,10 @@ async def cmd_triggers_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not (0 <= idx < len(items)):
         await update.message.reply_text("Неверный номер.")
         return
-    items[idx]["enabled"] = not items[idx].get("enabled", True)
-    _build_compiled_triggers_for_chat(chat_id)
-    async with STATE_LOCK:
-        await cloud_save()
+    t = _own_trigger(chat_id, idx)
+    t["enabled"] = not t.get("enabled", True)
+    _triggers_changed(chat_id)
+    request_save()
     st = "включён" if items[idx]["enabled"] else "выключен"
     await update.message.reply_text(f"Триггер «{items[idx].get('name','')}» {st}.")
 
@@ -1325,9 +3651,8 @@ async def cmd_triggers_del(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     name = items[idx].get("name","")
     del items[idx]
-    _build_compiled_triggers_for_chat(chat_id)
-    async with STATE_LOCK:
-        await cloud_save()
+    _triggers_changed(chat_id)
+    request_save()
     await update.message.reply_text(f"Триггер «{name}» удалён.")
 
 # ========= ДОБАВЛЕНИЕ ТРИГГЕРА — МАСТЕР В ЛС =========
@@ -1350,9 +3675,9 @@ async def cmd_triggers_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ADMIN_SESS[uid] = {
         "chat_id": chat_id,
         "step": "type",
-        "new_trigger": {"id": f"custom_{int(datetime.now().timestamp())}", "name": "Новый триггер",
+        "new_trigger": {"id": f"custom_{uuid.uuid4().hex[:8]}", "name": "Новый триггер",
                         "pattern": "", "is_regex": False, "ignore_case": True,
-                        "word_boundaries": False, "answers": [], "enabled": True}
+                        "word_boundaries": False, "answers": [], "enabled": True, "added_by": uid}
     }
     await update.message.reply_text(
         "Добавление триггера:\n"
@@ -1412,6 +3737,11 @@ async def _admin_dm_message_router(update: Update, context: ContextTypes.DEFAULT
             except Exception as e:
                 await update.message.reply_text(f"Невалидный регэксп: {e.__class__.__name__}")
                 return
+            await update.message.reply_text("Проверяю регэксп на тяжёлых строках…")
+            reason = await _vet_pattern(txt, re.IGNORECASE if new_tr["ignore_case"] else 0)
+            if reason:
+                await update.message.reply_text(f"Регэксп отклонён: {reason}. Введи попроще:")
+                return
             new_tr["pattern"] = txt
         else:
             new_tr["pattern"] = txt
@@ -1428,7 +3758,15 @@ async def _admin_dm_message_router(update: Update, context: ContextTypes.DEFAULT
     if step == "options":
         flags = set(txt.strip())
         if flags and flags != {"0"}:
-            new_tr["ignore_case"] = ("1" in flags)
+            icase = ("1" in flags)
+            if new_tr["is_regex"] and icase != new_tr["ignore_case"]:
+                # флаги поменялись — проверенный на шаге паттерна вариант уже не тот, что будет работать
+                reason = await _vet_pattern(new_tr["pattern"], re.IGNORECASE if icase else 0)
+                if reason:
+                    sess["step"] = "pattern"
+                    await update.message.reply_text(f"С этими опциями регэксп отклонён: {reason}. Введи попроще:")
+                    return
+            new_tr["ignore_case"] = icase
             if not new_tr["is_regex"]:
                 new_tr["word_boundaries"] = ("2" in flags)
         sess["step"] = "answers"
@@ -1447,9 +3785,8 @@ async def _admin_dm_message_router(update: Update, context: ContextTypes.DEFAULT
             # сохранить
             TRIGGERS_CFG.setdefault(chat_id, [])
             TRIGGERS_CFG[chat_id].append(TriggerCfg(dict(new_tr)))
-            _build_compiled_triggers_for_chat(chat_id)
-            async with STATE_LOCK:
-                await cloud_save()
+            _triggers_changed(chat_id)
+            request_save()
             await update.message.reply_text(f"✅ Триггер «{new_tr['name']}» добавлен.\n\n" + _format_triggers_list(chat_id))
             _reset_admin_wizard(uid)
             return
@@ -1461,9 +3798,8 @@ async def _admin_dm_message_router(update: Update, context: ContextTypes.DEFAULT
         if len(new_tr["answers"]) >= 3:
             TRIGGERS_CFG.setdefault(chat_id, [])
             TRIGGERS_CFG[chat_id].append(TriggerCfg(dict(new_tr)))
-            _build_compiled_triggers_for_chat(chat_id)
-            async with STATE_LOCK:
-                await cloud_save()
+            _triggers_changed(chat_id)
+            request_save()
             await update.message.reply_text(f"✅ Триггер «{new_tr['name']}» добавлен (3 ответа).\n\n" + _format_triggers_list(chat_id))
             _reset_admin_wizard(uid)
             return
@@ -1484,10 +3820,9 @@ async def cmd_resettriggers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await _is_admin(chat_id, uid, context):
         await update.message.reply_text("Недостаточно прав.")
         return
-    TRIGGERS_CFG[chat_id] = [TriggerCfg(dict(t)) for t in DEFAULT_TRIGGERS]
-    _build_compiled_triggers_for_chat(chat_id)
-    async with STATE_LOCK:
-        await cloud_save()
+    TRIGGERS_CFG[chat_id] = list(DEFAULT_TRIGGERS)
+    _triggers_changed(chat_id)
+    request_save()
     await update.message.reply_text("🔄 Триггеры сброшены к стандартным.\n\n" + _format_triggers_list(chat_id))
     try:
         await context.bot.send_message(chat_id, "ℹ️ Админ сбросил триггеры чата к стандартным.")
@@ -1512,13 +3847,13 @@ async def cmd_testtrigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пример: /testtrigger текст для проверки")
         return
     _ensure_triggers_migrated(chat_id)
-    compiled = TRIGGERS_COMPILED.get(chat_id, [])
+    compiled = _compiled_triggers(chat_id)
     hits = []
-    for idx, (pat, answers, name, enabled) in enumerate(compiled):
-        if enabled and pat and pat.search(sample):
-            # какой ответ бы выдал
-            ans = answers[0] if answers else "(нет ответов)"
-            hits.append(f"• {name} → «{ans}»")
+    for idx in compiled.all(sample):
+        _, answers, name, _ = compiled.items[idx]
+        # какой ответ бы выдал
+        ans = answers[0] if answers else "(нет ответов)"
+        hits.append(f"• {name} → «{ans}»")
     if not hits:
         await update.message.reply_text("Ни один триггер не сработал.")
     else:
@@ -1526,7 +3861,18 @@ async def cmd_testtrigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 _start_time = datetime.now(UTC)
 _last_keepalive_ok = None
-_last_save_time = None
+
+def _trigger_diag(chat_id: int) -> str:
+    """Сводка счётчиков триггеров чата + самые дорогие по суммарному времени."""
+    _ensure_triggers_migrated(chat_id)
+    items = TRIGGERS_CFG.get(chat_id) or []
+    stats = _trigger_stats(chat_id, _compiled_triggers(chat_id))
+    head = (f"Триггеры: проверок {sum(stats.evals)}, ответов {sum(stats.fires)}, "
+            f"кулдаун {sum(stats.suppressed)}, матчинг {sum(stats.ns) / 1e6:.2f} мс")
+    top = sorted((i for i in range(len(items)) if stats.ns[i]), key=lambda i: -stats.ns[i])[:3]
+    if top:
+        head += "; дороже всех: " + ", ".join(f"{items[i].get('name','')} {stats.ns[i] / 1e6:.2f} мс" for i in top)
+    return head
 
 async def cmd_diag(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not _is_private(update):
@@ -1540,38 +3886,58 @@ async def cmd_diag(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await _is_admin(chat_id, uid, context):
         await update.message.reply_text("Недостаточно прав.")
         return
-    # оценим размер состояния
-    try:
-        st_text = json.dumps(_serialize_state(), ensure_ascii=False)
-        kb = len(st_text.encode("utf-8")) // 1024
-    except Exception:
-        kb = -1
+    # размер — по тому, что уже лежит на диске: сериализовать всё ради /diag значит поднять
+    # ленивые чаты, выгруженные файлы и весь справочник прямо в цикле событий
+    kb = 0
+    for path in (getattr(STORAGE, "path", LOCAL_SNAPSHOT), USERS_DB, COLD_DIR):
+        try:
+            if os.path.isdir(path):
+                kb += sum(e.stat().st_size for e in os.scandir(path) if e.is_file()) // 1024
+            else:
+                kb += os.path.getsize(path) // 1024
+        except OSError:
+            pass
     uptime = datetime.now(UTC) - _start_time
     lines = [
         f"Чат: {CHAT_TITLES.get(chat_id, chat_id)}",
+        f"Ники: занято {len(_ensure_chat(chat_id).taken)} из {NICK_SPACE} комбинаций",
         f"Активных триггеров: {sum(1 for t in (TRIGGERS_CFG.get(chat_id) or []) if t.get('enabled', True))} / {len(TRIGGERS_CFG.get(chat_id) or [])}",
-        f"Последний автосейв: {_last_save_time.isoformat() if _last_save_time else '—'}",
-        f"Размер состояния: ~{kb} KB",
+        _trigger_diag(chat_id),
+        f"Последний автосейв: {_last_save_time.isoformat() if _last_save_time else '—'} (интервал ~{int(_save_interval())} с)",
+        f"Версия состояния: {_JOURNAL_SEQ} (в гисте: {_GIST_SEQ if _GIST_SEQ >= 0 else '—'})",
+        f"Размер состояния на диске: ~{kb} KB (последний снапшот: {_LAST_SNAPSHOT_BYTES // 1024} KB, {SNAPSHOT_CODEC})",
+        f"Чаты в памяти: {len(CHATS)}, выгружено: {len(_COLD_CHATS)} "
+        f"(выгрузок {COLD_STATS['evicted']}, ~{COLD_STATS['evict_ms'] / max(1, COLD_STATS['evicted']):.1f} мс; "
+        f"подъёмов {COLD_STATS['thawed']}, ~{COLD_STATS['thaw_ms'] / max(1, COLD_STATS['thawed']):.1f} мс; "
+        f"битых файлов {COLD_STATS['corrupt']})",
+        f"Справочник: в памяти {len(NAMES.hot)}+{len(KNOWN.hot)} (макс. {USERS_HOT_MAX}), "
+        f"подгрузок с диска {NAMES.faults + KNOWN.faults}, вытеснено {NAMES.evictions + KNOWN.evictions}",
         f"Uptime процесса: {uptime}",
         f"Последний keepalive: {_last_keepalive_ok if _last_keepalive_ok is not None else '—'}",
     ]
     await update.message.reply_text("🛠 Диагностика:\n" + "\n".join(lines))
 
 # ========= HEALTH JOBS =========
-async def periodic_save_job(context: ContextTypes.DEFAULT_TYPE):
-    global _last_save_time
-    async with STATE_LOCK:
-        await cloud_save()
-        _last_save_time = datetime.now(UTC)
+async def journal_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    await journal_flush()
+
+async def limits_sweep_job(context: ContextTypes.DEFAULT_TYPE):
+    """Выкинуть истёкшие окна лимитов, чтобы не копились и не попадали в снапшот."""
+    now = int(datetime.now(UTC).timestamp())
+    for cid, st in CHATS.items():
+        if REP_LIMIT.sweep(st.rep_rings, now):
+            _touch(cid, active=False)
+    if NICK_LIMIT.sweep(LAST_NICK, now):
+        _touch_global("LAST_NICK")
+    TRIGGER_LIMIT.sweep(LAST_TRIGGER_TIME, now)
 
 async def keepalive_job(context: ContextTypes.DEFAULT_TYPE):
     global _last_keepalive_ok
     if not SELF_URL:
         return
     try:
-        async with httpx.AsyncClient(timeout=8.0) as client:
-            r = await client.get(SELF_URL)
-            _last_keepalive_ok = (r.status_code, r.text[:50])
+        r = await _http_request("GET", SELF_URL, "keepalive")
+        _last_keepalive_ok = (r.status_code, r.text[:50])
     except Exception as e:
         _last_keepalive_ok = f"error: {e.__class__.__name__}"
 
@@ -1603,7 +3969,15 @@ async def _pre_init(app: Application):
         await app.bot.delete_webhook(drop_pending_updates=True)
     except Exception:
         pass
-    await cloud_load_if_any()
+    _http()
+    await STORAGE.load()
+    start_save_scheduler()
+
+async def _post_shutdown(app: Application):
+    await stop_save_scheduler()
+    STORAGE.close()
+    _users_close()
+    await _http_close()
 
 def main():
     # Flask
@@ -1615,6 +3989,7 @@ def main():
         .token(API_TOKEN)
         .get_updates_request(req)
         .post_init(_pre_init)
+        .post_shutdown(_post_shutdown)
         .build()
     )
 
@@ -1623,6 +3998,7 @@ def main():
     application.add_handler(CommandHandler("help",  cmd_help))
     application.add_handler(CommandHandler("nick",  cmd_nick))
     application.add_handler(CommandHandler("8ball", cmd_8ball))
+    application.add_handler(CommandHandler("rank",  cmd_rank))
 
     # Статистика
     application.add_handler(CallbackQueryHandler(on_button))
@@ -1631,6 +4007,8 @@ def main():
     application.add_handler(CommandHandler("export", cmd_export))
     application.add_handler(CommandHandler("export_here", cmd_export_here))
     application.add_handler(CommandHandler("import", cmd_import))
+    # CommandHandler подписи документов не видит: файл с подписью /import ловим отдельно
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import(@\w+)?(\s|$)"), cmd_import))
 
     # Сбросы
     application.add_handler(CommandHandler("reset", cmd_reset))
@@ -1660,11 +4038,15 @@ def main():
     # Авто-выход из неразрешённых чатов по событиям
     application.add_handler(ChatMemberHandler(on_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
 
-    # JobQueue: автосейв и keep-alive
+    # JobQueue: keep-alive, флаш журнала, чистка окон лимитов и выгрузка простаивающих чатов
+    # (чекпоинты — планировщик сохранений)
     jq = application.job_queue
     if jq is not None:
-        jq.run_repeating(periodic_save_job, interval=300, first=120)   # каждые 5 мин
         jq.run_repeating(keepalive_job,     interval=240, first=60)    # каждые 4 мин
+        jq.run_repeating(limits_sweep_job,  interval=LIMITS_SWEEP_SEC, first=LIMITS_SWEEP_SEC)
+        jq.run_repeating(idle_chats_job,    interval=IDLE_CHECK_SEC, first=IDLE_CHECK_SEC)
+        if JOURNAL_ENABLED:
+            jq.run_repeating(journal_flush_job, interval=JOURNAL_FLUSH_SEC, first=JOURNAL_FLUSH_SEC)
 
     from telegram import Update as TgUpdate
     application.run_polling(